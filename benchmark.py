@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+from modules import benchmark
+
+if __name__ == '__main__':
+    benchmark.run()
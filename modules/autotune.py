@@ -0,0 +1,103 @@
+import json
+import os
+import platform
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+import cv2
+import numpy
+
+import modules.globals
+from modules.face_analyser import get_many_faces
+from modules.processors.frame.core import get_frame_processors_modules, handle_frame
+from modules.session_pool import clear_sessions
+from modules.typing import Frame
+from modules.utilities import is_image, resolve_relative_path
+
+AUTOTUNE_FILE = resolve_relative_path('../models/autotune.json')
+AUTOTUNE_FRAME_SIZE = (1280, 720)
+AUTOTUNE_DURATION = 3.0
+
+
+def get_autotune_key() -> str:
+    return '|'.join([platform.node(), platform.machine(), str(os.cpu_count()), ','.join(modules.globals.execution_providers), ','.join(sorted(modules.globals.frame_processors))])
+
+
+def load_autotune_cache() -> Dict[str, Any]:
+    try:
+        with open(AUTOTUNE_FILE) as autotune_file:
+            return json.load(autotune_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_tuned_config() -> Dict[str, Any]:
+    return load_autotune_cache().get(get_autotune_key(), {})
+
+
+def save_tuned_config(tuned_config: Dict[str, Any]) -> None:
+    autotune_cache = load_autotune_cache()
+    autotune_cache[get_autotune_key()] = tuned_config
+    with open(AUTOTUNE_FILE, 'w') as autotune_file:
+        json.dump(autotune_cache, autotune_file, indent=4)
+
+
+def get_sweep() -> List[Tuple[int, int]]:
+    cpu_count = os.cpu_count() or 1
+    execution_threads = sorted({min(threads, cpu_count * 2) for threads in [1, 2, 4, 8, 16, 32, 64]})
+    if modules.globals.execution_providers != ['CPUExecutionProvider']:
+        # intra-op threads only matter when the models run on the cpu
+        return [(threads, 1) for threads in execution_threads if threads <= 16]
+    sweep = []
+    for threads in execution_threads:
+        for intra_op_threads in sorted({1, 2, 4, max(1, cpu_count // threads)}):
+            if threads * intra_op_threads <= cpu_count * 2:
+                sweep.append((threads, intra_op_threads))
+    return sweep
+
+
+def create_autotune_frame() -> Frame:
+    frame = numpy.zeros((AUTOTUNE_FRAME_SIZE[1], AUTOTUNE_FRAME_SIZE[0], 3), dtype=numpy.uint8)
+    if is_image(modules.globals.source_path):
+        # paste the source face into a typical frame so detection and swap have work to do
+        source_frame = cv2.imread(modules.globals.source_path)
+        scale = min(AUTOTUNE_FRAME_SIZE[0] / source_frame.shape[1], AUTOTUNE_FRAME_SIZE[1] / source_frame.shape[0]) / 2
+        source_frame = cv2.resize(source_frame, None, fx=scale, fy=scale)
+        frame[:source_frame.shape[0], :source_frame.shape[1]] = source_frame
+    return frame
+
+
+def measure_fps(frame: Frame) -> float:
+    if is_image(modules.globals.source_path):
+        frame_handlers = [frame_processor.create_frame_handler(modules.globals.source_path) for frame_processor in get_frame_processors_modules(modules.globals.frame_processors)]
+        process = lambda: handle_frame(frame_handlers, 0, frame.copy())
+    else:
+        process = lambda: get_many_faces(frame, 'detection')
+    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
+        # warm up every thread and session before measuring
+        list(executor.map(lambda _: process(), range(modules.globals.execution_threads)))
+        frame_total = 0
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < AUTOTUNE_DURATION:
+            list(executor.map(lambda _: process(), range(modules.globals.execution_threads)))
+            frame_total += modules.globals.execution_threads
+        return frame_total / (time.perf_counter() - start_time)
+
+
+def autotune() -> Dict[str, Any]:
+    frame = create_autotune_frame()
+    tuned_config: Dict[str, Any] = {}
+    for execution_threads, intra_op_threads in get_sweep():
+        modules.globals.execution_threads = execution_threads
+        modules.globals.intra_op_threads = intra_op_threads
+        clear_sessions()
+        fps = measure_fps(frame)
+        print(f'[DLC.AUTOTUNE] execution_threads={execution_threads} intra_op_threads={intra_op_threads} fps={fps:.2f}')
+        if fps > tuned_config.get('fps', 0):
+            tuned_config = {'execution_threads': execution_threads, 'intra_op_threads': intra_op_threads, 'fps': fps}
+    clear_sessions()
+    if tuned_config:
+        modules.globals.execution_threads = tuned_config['execution_threads']
+        modules.globals.intra_op_threads = tuned_config['intra_op_threads']
+        save_tuned_config(tuned_config)
+    return tuned_config
@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+import cv2
+import numpy
+import psutil
+
+import modules.globals
+import modules.metadata
+from modules.face_analyser import get_one_face, get_many_faces, get_unique_faces_from_target_video, get_face_analysis_path
+from modules.frame_store import release_frame_store
+from modules.metrics import get_percentile
+from modules.processors.frame.core import get_frame_processors_modules, process_frame_stream
+from modules.processors.frame.face_enhancer import enhance_face
+from modules.processors.frame.face_swapper import swap_face
+from modules.utilities import is_image, stream_frames, create_video_writer, write_video_frame, close_video_writer, clean_temp, resolve_relative_path
+
+BENCHMARKS = ['get_one_face', 'get_many_faces', 'swap_face', 'enhance_face', 'process_video', 'map_faces']
+BENCHMARK_CLIP_DIRECTORY = resolve_relative_path('../benchmark-clips')
+BENCHMARK_FPS = 25.0
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def parse_args() -> argparse.Namespace:
+    program = argparse.ArgumentParser(description='benchmark the cpu pipeline on synthetic clips')
+    program.add_argument('-s', '--source', help='select a source image with one face, it is also tiled into the synthetic clips', dest='source_path')
+    program.add_argument('-o', '--output', help='write the results to this json file', dest='output_path')
+    program.add_argument('--benchmark', help='benchmarks to run', dest='benchmarks', default=BENCHMARKS, choices=BENCHMARKS, nargs='+')
+    program.add_argument('--resolution', help='clip resolutions as WIDTHxHEIGHT', dest='resolutions', default=['640x360', '1280x720', '1920x1080'], nargs='+')
+    program.add_argument('--faces', help='faces per clip', dest='face_totals', type=int, default=[1, 3], nargs='+')
+    program.add_argument('--frames', help='frames per clip', dest='frame_total', type=int, default=50)
+    program.add_argument('--iterations', help='calls per single frame benchmark', dest='iterations', type=int, default=20)
+    program.add_argument('--execution-threads', help='number of execution threads for the video benchmarks', dest='execution_threads', type=int, default=4)
+    program.add_argument('--compare', help='compare two result files instead of running the benchmarks', dest='compare', nargs=2, metavar=('BASE', 'HEAD'))
+    program.add_argument('--threshold', help='fps drop in percent that counts as a regression when comparing', dest='threshold', type=float, default=5.0)
+    return program.parse_args()
+
+
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    width, height = resolution.lower().split('x')
+    return int(width), int(height)
+
+
+def get_git_revision() -> Any:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=resolve_relative_path('..'), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def get_environment() -> Dict[str, Any]:
+    return {
+        'version': modules.metadata.version,
+        'revision': get_git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'execution_providers': modules.globals.execution_providers,
+        'execution_threads': modules.globals.execution_threads
+    }
+
+
+def create_clip_frame(source_frame: numpy.ndarray, resolution: Tuple[int, int], face_total: int, frame_number: int) -> numpy.ndarray:
+    width, height = resolution
+    # a fixed seed keeps the clips identical between runs and commits
+    frame = numpy.random.default_rng(0).integers(32, 96, (height, width, 3), dtype=numpy.uint8)
+    columns = int(numpy.ceil(numpy.sqrt(face_total)))
+    rows = int(numpy.ceil(face_total / columns))
+    cell_width, cell_height = width // columns, height // rows
+    scale = min(cell_width / source_frame.shape[1], cell_height / source_frame.shape[0]) * 0.8
+    face_frame = cv2.resize(source_frame, None, fx=scale, fy=scale)
+    face_height, face_width = face_frame.shape[:2]
+    for face_index in range(face_total):
+        # drift every face a little so trackers and caches see motion
+        offset_x = int((cell_width - face_width) / 2 + numpy.sin(frame_number / 8 + face_index) * (cell_width - face_width) / 4)
+        offset_y = int((cell_height - face_height) / 2 + numpy.cos(frame_number / 8 + face_index) * (cell_height - face_height) / 4)
+        x = face_index % columns * cell_width + offset_x
+        y = face_index // columns * cell_height + offset_y
+        frame[y:y + face_height, x:x + face_width] = face_frame
+    return frame
+
+
+def get_clip(source_frame: numpy.ndarray, resolution: Tuple[int, int], face_total: int, frame_total: int) -> str:
+    width, height = resolution
+    clip_path = os.path.join(BENCHMARK_CLIP_DIRECTORY, f'{width}x{height}-{face_total}faces-{frame_total}frames.mp4')
+    if not os.path.isfile(clip_path):
+        os.makedirs(BENCHMARK_CLIP_DIRECTORY, exist_ok=True)
+        video_writer = create_video_writer(clip_path, resolution, BENCHMARK_FPS, output_path=clip_path)
+        try:
+            for frame_number in range(frame_total):
+                write_video_frame(video_writer, create_clip_frame(source_frame, resolution, face_total, frame_number))
+        finally:
+            close_video_writer(video_writer)
+    return clip_path
+
+
+def measure_peak_rss(function: Callable[[], Any]) -> Tuple[Any, float]:
+    process = psutil.Process()
+    peak_rss = [process.memory_info().rss]
+    stop_event = threading.Event()
+
+    def sample_rss() -> None:
+        while not stop_event.wait(RSS_SAMPLE_INTERVAL):
+            peak_rss[0] = max(peak_rss[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    try:
+        result = function()
+    finally:
+        stop_event.set()
+        sampler.join()
+    return result, max(peak_rss[0], process.memory_info().rss) / 1024 / 1024
+
+
+def benchmark_calls(function: Callable[[numpy.ndarray], Any], frames: List[numpy.ndarray], iterations: int) -> Dict[str, float]:
+    # the first call loads the models and is not part of the result
+    function(frames[0])
+
+    def run_calls() -> List[float]:
+        durations = []
+        for iteration in range(iterations):
+            start_time = time.perf_counter()
+            function(frames[iteration % len(frames)])
+            durations.append(time.perf_counter() - start_time)
+        return durations
+
+    durations, peak_rss = measure_peak_rss(run_calls)
+    durations.sort()
+    return {
+        'fps': round(len(durations) / sum(durations), 3),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+        'p50_ms': round(get_percentile(durations, 50) * 1000, 3),
+        'p90_ms': round(get_percentile(durations, 90) * 1000, 3),
+        'peak_rss_mb': round(peak_rss, 1)
+    }
+
+
+def benchmark_frames(function: Callable[[], Any], frame_total: int) -> Dict[str, float]:
+    start_time = time.perf_counter()
+    _, peak_rss = measure_peak_rss(function)
+    elapsed = time.perf_counter() - start_time
+    return {
+        'fps': round(frame_total / elapsed, 3),
+        'elapsed_s': round(elapsed, 3),
+        'peak_rss_mb': round(peak_rss, 1)
+    }
+
+
+def run_process_video(clip_path: str, resolution: Tuple[int, int], frame_total: int) -> None:
+    modules.globals.target_path = clip_path
+    output_path = os.path.splitext(clip_path)[0] + '-output.mp4'
+    video_writer = create_video_writer(clip_path, resolution, BENCHMARK_FPS, output_path=output_path)
+    try:
+        process_frame_stream(stream_frames(clip_path), get_frame_processors_modules(modules.globals.frame_processors), lambda frame_number, temp_frame: write_video_frame(video_writer, temp_frame), frame_total)
+    finally:
+        close_video_writer(video_writer)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+
+
+def run_map_faces(clip_path: str) -> None:
+    modules.globals.target_path = clip_path
+    # a cached analysis from an earlier run would only time loading it
+    if os.path.isfile(get_face_analysis_path(clip_path)):
+        os.remove(get_face_analysis_path(clip_path))
+    try:
+        get_unique_faces_from_target_video()
+    finally:
+        release_frame_store(clip_path)
+        clean_temp(clip_path)
+
+
+def run_case(benchmarks: List[str], source_frame: numpy.ndarray, clip_path: str, resolution: Tuple[int, int], frame_total: int, iterations: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    frames = [frame for _, frame in stream_frames(clip_path)][:iterations]
+    source_face = get_one_face(source_frame)
+    target_face = get_one_face(frames[0])
+    if 'get_one_face' in benchmarks:
+        results['get_one_face'] = benchmark_calls(get_one_face, frames, iterations)
+    if 'get_many_faces' in benchmarks:
+        results['get_many_faces'] = benchmark_calls(get_many_faces, frames, iterations)
+    if 'swap_face' in benchmarks and source_face and target_face:
+        # the detection is shared, so only the swap and its paste back are measured
+        results['swap_face'] = benchmark_calls(lambda frame: swap_face(source_face, target_face, frame), frames, iterations)
+    if 'enhance_face' in benchmarks:
+        results['enhance_face'] = benchmark_calls(enhance_face, frames, iterations)
+    if 'process_video' in benchmarks:
+        results['process_video'] = benchmark_frames(lambda: run_process_video(clip_path, resolution, frame_total), frame_total)
+    if 'map_faces' in benchmarks:
+        results['map_faces'] = benchmark_frames(lambda: run_map_faces(clip_path), frame_total)
+    return results
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict[str, Any]:
+    modules.globals.source_path = args.source_path
+    modules.globals.execution_providers = ['CPUExecutionProvider']
+    modules.globals.execution_threads = args.execution_threads
+    modules.globals.frame_processors = ['face_swapper', 'face_enhancer'] if 'enhance_face' in args.benchmarks else ['face_swapper']
+    modules.globals.many_faces = False
+    modules.globals.map_faces = False
+    modules.globals.keep_fps = True
+    modules.globals.video_encoder = 'libx264'
+    modules.globals.video_quality = 18
+    modules.globals.headless = True
+    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+        if not frame_processor.pre_check():
+            sys.exit(1)
+    source_frame = cv2.imread(args.source_path)
+    results: Dict[str, Any] = {}
+    for resolution in map(parse_resolution, args.resolutions):
+        for face_total in args.face_totals:
+            clip_path = get_clip(source_frame, resolution, face_total, args.frame_total)
+            case_name = f'{resolution[0]}x{resolution[1]}-{face_total}faces'
+            print(f'[DLC.BENCHMARK] {case_name}')
+            for benchmark_name, result in run_case(args.benchmarks, source_frame, clip_path, resolution, args.frame_total, args.iterations).items():
+                results[f'{benchmark_name}/{case_name}'] = result
+                print(f'[DLC.BENCHMARK] {benchmark_name}/{case_name} ' + ' '.join(f'{key}={value}' for key, value in result.items()))
+    return {'environment': get_environment(), 'results': results}
+
+
+def compare_results(base_path: str, head_path: str, threshold: float) -> bool:
+    with open(base_path) as base_file, open(head_path) as head_file:
+        base_results = json.load(base_file)['results']
+        head_results = json.load(head_file)['results']
+    regressed = False
+    print(f"{'benchmark':<48} {'base fps':>10} {'head fps':>10} {'change':>8} {'base rss':>10} {'head rss':>10}")
+    for name in sorted(set(base_results) & set(head_results)):
+        base, head = base_results[name], head_results[name]
+        change = (head['fps'] - base['fps']) / base['fps'] * 100 if base['fps'] else 0.0
+        flag = ''
+        if change < -threshold:
+            regressed = True
+            flag = ' !'
+        print(f"{name:<48} {base['fps']:>10.2f} {head['fps']:>10.2f} {change:>+7.1f}% {base['peak_rss_mb']:>8.1f}MB {head['peak_rss_mb']:>8.1f}MB{flag}")
+    for name in sorted(set(base_results) ^ set(head_results)):
+        print(f"{name:<48} only in {'base' if name in base_results else 'head'}")
+    return not regressed
+
+
+def run() -> None:
+    args = parse_args()
+    if args.compare:
+        sys.exit(0 if compare_results(args.compare[0], args.compare[1], args.threshold) else 1)
+    if not is_image(args.source_path):
+        print('[DLC.BENCHMARK] Select an image with one face for source path.')
+        sys.exit(1)
+    benchmark_report = run_benchmarks(args)
+    if args.output_path:
+        with open(args.output_path, 'w') as output_file:
+            json.dump(benchmark_report, output_file, indent=4)
+        print(f'[DLC.BENCHMARK] Results written to {args.output_path}')
@@ -1,32 +1,104 @@
-from typing import Any
+from collections import OrderedDict
+from typing import Any, List
+import bisect
+import os
+import threading
 import cv2
 import modules.globals  # Import the globals to check the color correction toggle
+from modules.utilities import detect_keyframe_numbers
+
+VIDEO_READERS: OrderedDict[Any, Any] = OrderedDict()
+VIDEO_READERS_LOCK = threading.Lock()
+MAX_VIDEO_READERS = 4
+# decoded frames kept per reader, fewer frames are kept for larger resolutions
+FRAME_CACHE_BYTES = 128 * 1024 * 1024
+
+
+class VideoReader:
+    def __init__(self, video_path: str) -> None:
+        self.video_path = video_path
+        self.capture = cv2.VideoCapture(video_path)
+        self.frame_total = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.position = 0
+        self.keyframes: List[int] = None
+        self.frame_cache: OrderedDict[int, Any] = OrderedDict()
+        self.frame_cache_bytes = 0
+        self.lock = threading.Lock()
+
+    def get_keyframes(self) -> List[int]:
+        # built once per reader
+        if self.keyframes is None:
+            self.keyframes = detect_keyframe_numbers(self.video_path)
+        return self.keyframes
+
+    def read(self, frame_number: int) -> Any:
+        frame_number = max(0, min(frame_number, self.frame_total - 1))
+        with self.lock:
+            if frame_number not in self.frame_cache:
+                self.decode_to(frame_number)
+            if frame_number not in self.frame_cache:
+                return None
+            self.frame_cache.move_to_end(frame_number)
+            return self.frame_cache[frame_number].copy()
+
+    def decode_to(self, frame_number: int) -> None:
+        keyframes = self.get_keyframes()
+        keyframe = keyframes[max(0, bisect.bisect_right(keyframes, frame_number) - 1)]
+        # continue from the current position unless seeking to a keyframe is closer
+        if frame_number < self.position or keyframe > self.position:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            self.position = keyframe
+        while self.position <= frame_number:
+            has_frame, frame = self.capture.read()
+            if not has_frame:
+                break
+            self.cache_frame(self.position, frame)
+            self.position += 1
+
+    def cache_frame(self, frame_number: int, frame: Any) -> None:
+        if frame_number in self.frame_cache:
+            self.frame_cache_bytes -= self.frame_cache[frame_number].nbytes
+        self.frame_cache[frame_number] = frame
+        self.frame_cache_bytes += frame.nbytes
+        self.frame_cache.move_to_end(frame_number)
+        while len(self.frame_cache) > 1 and self.frame_cache_bytes > FRAME_CACHE_BYTES:
+            _, cached_frame = self.frame_cache.popitem(last=False)
+            self.frame_cache_bytes -= cached_frame.nbytes
+
+    def release(self) -> None:
+        with self.lock:
+            self.capture.release()
+            self.frame_cache.clear()
+            self.frame_cache_bytes = 0
+
+
+def get_video_reader(video_path: str) -> VideoReader:
+    key = (video_path, os.path.getmtime(video_path) if os.path.isfile(video_path) else None)
+    with VIDEO_READERS_LOCK:
+        if key not in VIDEO_READERS:
+            VIDEO_READERS[key] = VideoReader(video_path)
+            while len(VIDEO_READERS) > MAX_VIDEO_READERS:
+                _, video_reader = VIDEO_READERS.popitem(last=False)
+                video_reader.release()
+        VIDEO_READERS.move_to_end(key)
+        return VIDEO_READERS[key]
+
+
+def release_video_reader(video_path: str) -> None:
+    with VIDEO_READERS_LOCK:
+        for key in [key for key in VIDEO_READERS if key[0] == video_path]:
+            VIDEO_READERS.pop(key).release()
 
 
 def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
-    capture = cv2.VideoCapture(video_path)
-
-    # Set MJPEG format to ensure correct color space handling
-    capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-    
-    # Only force RGB conversion if color correction is enabled
-    if modules.globals.color_correction:
-        capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
-    
-    frame_total = capture.get(cv2.CAP_PROP_FRAME_COUNT)
-    capture.set(cv2.CAP_PROP_POS_FRAMES, min(frame_total, frame_number - 1))
-    has_frame, frame = capture.read()
-
-    if has_frame and modules.globals.color_correction:
+    frame = get_video_reader(video_path).read(frame_number - 1)
+
+    if frame is not None and modules.globals.color_correction:
         # Convert the frame color if necessary
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-    capture.release()
-    return frame if has_frame else None
+    return frame
 
 
 def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    return get_video_reader(video_path).frame_total
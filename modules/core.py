@@ -11,6 +11,8 @@ import platform
 import signal
 import shutil
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import onnxruntime
 import tensorflow
@@ -18,8 +20,14 @@ import tensorflow
 import modules.globals
 import modules.metadata
 import modules.ui as ui
-from modules.processors.frame.core import get_frame_processors_modules
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from modules.autotune import autotune, get_tuned_config
+from modules.face_analyser import DET_SIZES, take_analysis_frames
+from modules.frame_store import get_frame_store, release_frame_store
+from modules.job_manifest import is_job_resumable, create_job_manifest, close_job_manifest
+from modules.metrics import reset_stages, write_stage_report
+from modules.profiler import profile, profiled, flush_profile
+from modules.processors.frame.core import get_frame_processors_modules, has_frame_handlers, process_frame_stream, process_frame_store, process_video_segments
+from modules.utilities import has_image_extension, is_image, is_video, detect_fps, detect_frame_total, can_mux_audio, detect_resolution, get_video_segments, concat_videos, create_video_writer, write_video_frame, close_video_writer, stream_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path, is_batch_target, get_batch_jobs, prefetch_file
 
 if 'ROCMExecutionProvider' in modules.globals.execution_providers:
     del torch
@@ -32,12 +40,14 @@ def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser()
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
-    program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
+    program.add_argument('-t', '--target', help='select an target image or video, or a directory, glob or manifest of targets', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
     program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
+    program.add_argument('--resume', help='keep temporary frames of interrupted jobs and skip completed frames on the next run', dest='resume', action='store_true', default=False)
+    program.add_argument('--frame-store', help='storage for temporary frames', dest='frame_store', default='png', choices=['png', 'mmap', 'memory'])
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
     program.add_argument('--map-faces', help='map source target faces', dest='map_faces', action='store_true', default=False)
@@ -47,7 +57,25 @@ def parse_args() -> None:
     program.add_argument('--live-resizable', help='The live camera frame is resizable', dest='live_resizable', action='store_true', default=False)
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
-    program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int)
+    program.add_argument('--intra-op-threads', help='number of threads inside each model call, 0 splits the cores between the execution threads', dest='intra_op_threads', type=int)
+    program.add_argument('--autotune', help='benchmark thread settings on this host and cache the fastest for later runs', dest='autotune', action='store_true', default=False)
+    program.add_argument('--session-per-thread', help='give every execution thread its own model sessions', dest='session_per_thread', action='store_true', default=False)
+    program.add_argument('--execution-backend', help='run frame processing in threads or in worker processes with their own model sessions', dest='execution_backend', default='thread', choices=['thread', 'process'])
+    program.add_argument('--no-fuse-frame-processors', help='run each frame processor over the whole video in turn', dest='fuse_frame_processors', action='store_false', default=True)
+    program.add_argument('--decode-threads', help='number of frame decode threads', dest='decode_threads', type=int, default=2)
+    program.add_argument('--write-threads', help='number of frame write threads', dest='write_threads', type=int, default=2)
+    program.add_argument('--batch-size', help='number of frames per model call for frame processors that support batches', dest='batch_size', type=int, default=1)
+    program.add_argument('--frame-queue-size', help='number of frames buffered between pipeline stages', dest='frame_queue_size', type=int, default=16)
+    program.add_argument('--det-size', help='face detector input size, auto picks it per frame from the resolution and --face-scale', dest='det_size', default='auto', choices=['auto'] + [str(size) for size in DET_SIZES])
+    program.add_argument('--face-scale', help='expected size of the smallest face relative to the longer frame side, used by --det-size auto', dest='face_scale', type=float, default=0.05)
+    program.add_argument('--face-tracker-interval', help='detect faces every N frames and track them in between, for the live preview and single threaded videos', dest='face_tracker_interval', type=int, default=1)
+    program.add_argument('--analysis-batch-size', help='number of frames per detector call when analysing the target for --map-faces', dest='analysis_batch_size', type=int, default=8)
+    program.add_argument('--map-faces-sample-interval', help='find the --map-faces identities on every nth frame and the keyframes only, 0 analyses every frame', dest='map_faces_sample_interval', type=int, default=0)
+    program.add_argument('--metrics-report', help='write per-stage timings of each job next to its output', dest='metrics_report', action='store_true', default=False)
+    program.add_argument('--profile', help='sample the stacks of all threads while processing and write them as collapsed stacks for flamegraph tools', dest='profile_path')
+    program.add_argument('--profile-interval', help='milliseconds between profile samples', dest='profile_interval', type=float, default=5.0)
+    program.add_argument('--video-segments', help='split the target video at keyframes and process the segments in parallel processes', dest='video_segments', type=int, default=1)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -61,11 +89,16 @@ def parse_args() -> None:
     modules.globals.source_path = args.source_path
     modules.globals.target_path = args.target_path
     modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
+    modules.globals.batch_jobs = []
+    if is_batch_target(modules.globals.target_path):
+        modules.globals.batch_jobs = get_batch_jobs(modules.globals.source_path, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
     modules.globals.headless = args.source_path or args.target_path or args.output_path
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
+    modules.globals.frame_store = args.frame_store
+    modules.globals.resume = args.resume
     modules.globals.many_faces = args.many_faces
     modules.globals.nsfw_filter = args.nsfw_filter
     modules.globals.map_faces = args.map_faces
@@ -75,7 +108,29 @@ def parse_args() -> None:
     modules.globals.live_resizable = args.live_resizable
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
-    modules.globals.execution_threads = args.execution_threads
+    # explicit settings win over the tuned settings cached for this host
+    tuned_config = get_tuned_config()
+    modules.globals.execution_threads = args.execution_threads or tuned_config.get('execution_threads') or suggest_execution_threads()
+    # the tuned intra-op threads only fit the tuned execution threads, otherwise 0 splits the cores
+    tuned_intra_op_threads = tuned_config.get('intra_op_threads', 0) if not (args.execution_threads or args.cpu_cores_deprecated or args.gpu_threads_deprecated) and tuned_config.get('execution_threads') else 0
+    modules.globals.intra_op_threads = args.intra_op_threads if args.intra_op_threads is not None else tuned_intra_op_threads
+    modules.globals.autotune = args.autotune
+    modules.globals.session_per_thread = args.session_per_thread
+    modules.globals.execution_backend = args.execution_backend
+    modules.globals.fuse_frame_processors = args.fuse_frame_processors
+    modules.globals.decode_threads = args.decode_threads
+    modules.globals.write_threads = args.write_threads
+    modules.globals.batch_size = args.batch_size
+    modules.globals.frame_queue_size = args.frame_queue_size
+    modules.globals.video_segments = args.video_segments
+    modules.globals.det_size = args.det_size
+    modules.globals.face_scale = args.face_scale
+    modules.globals.face_tracker_interval = args.face_tracker_interval
+    modules.globals.analysis_batch_size = args.analysis_batch_size
+    modules.globals.map_faces_sample_interval = args.map_faces_sample_interval
+    modules.globals.metrics_report = args.metrics_report
+    modules.globals.profile_path = args.profile_path
+    modules.globals.profile_interval = args.profile_interval
 
     #for ENHANCER tumbler:
     if 'face_enhancer' in args.frame_processor:
@@ -88,6 +143,8 @@ def parse_args() -> None:
         print('\033[33mArgument -f and --face are deprecated. Use -s and --source instead.\033[0m')
         modules.globals.source_path = args.source_path_deprecated
         modules.globals.output_path = normalize_output_path(args.source_path_deprecated, modules.globals.target_path, args.output_path)
+        if is_batch_target(modules.globals.target_path):
+            modules.globals.batch_jobs = get_batch_jobs(modules.globals.source_path, modules.globals.target_path, args.output_path)
     if args.cpu_cores_deprecated:
         print('\033[33mArgument --cpu-cores is deprecated. Use --execution-threads instead.\033[0m')
         modules.globals.execution_threads = args.cpu_cores_deprecated
@@ -163,6 +220,10 @@ def pre_check() -> bool:
     if not shutil.which('ffmpeg'):
         update_status('ffmpeg is not installed.')
         return False
+    # every job of a batch needs its own output, a single output file would be overwritten by each job
+    if len({output_path for _, _, output_path in modules.globals.batch_jobs}) < len(modules.globals.batch_jobs):
+        update_status('Select an output directory for a batch of targets.')
+        return False
     return True
 
 
@@ -171,11 +232,35 @@ def update_status(message: str, scope: str = 'DLC.CORE') -> None:
     if not modules.globals.headless:
         ui.update_status(message)
 
+
+def write_job_report(start_time: float) -> None:
+    if not modules.globals.metrics_report or not modules.globals.output_path:
+        return
+    report_path = os.path.splitext(modules.globals.output_path)[0] + '.metrics.json'
+    write_stage_report(report_path, {
+        'source_path': modules.globals.source_path,
+        'target_path': modules.globals.target_path,
+        'output_path': modules.globals.output_path,
+        'frame_processors': modules.globals.frame_processors,
+        'execution_providers': modules.globals.execution_providers,
+        'execution_threads': modules.globals.execution_threads,
+        'intra_op_threads': modules.globals.intra_op_threads,
+        'execution_backend': modules.globals.execution_backend,
+        'frame_store': modules.globals.frame_store,
+        'batch_size': modules.globals.batch_size,
+        'video_segments': modules.globals.video_segments,
+        'elapsed_s': round(time.perf_counter() - start_time, 3)
+    })
+    update_status(f'Metrics written to {report_path}')
+
+
 def start() -> None:
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_start():
             return
     update_status('Processing...')
+    reset_stages()
+    start_time = time.perf_counter()
     # process image to image
     if has_image_extension(modules.globals.target_path):
         if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
@@ -192,33 +277,89 @@ def start() -> None:
             update_status('Processing to image succeed!')
         else:
             update_status('Processing to image failed!')
+        write_job_report(start_time)
         return
     # process image to videos
     if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
         return
 
-    if not modules.globals.map_faces:
-        update_status('Creating temp resources...')
-        create_temp(modules.globals.target_path)
-        update_status('Extracting frames...')
-        extract_frames(modules.globals.target_path)
-
-    temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
-        release_resources()
-    # handles fps
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    fps = 30.0
     if modules.globals.keep_fps:
         update_status('Detecting fps...')
         fps = detect_fps(modules.globals.target_path)
-        update_status(f'Creating video with {fps} fps...')
-        create_video(modules.globals.target_path, fps)
+    # copy the source audio during the encode, the separate remux pass is only a fallback
+    mux_audio = modules.globals.keep_audio and can_mux_audio(modules.globals.target_path)
+    if mux_audio and not modules.globals.keep_fps:
+        update_status('Muxing audio might cause issues as fps are not kept...')
+    # resuming needs the frames and the job manifest on disk
+    resumable = modules.globals.resume and not modules.globals.map_faces and modules.globals.frame_store != 'memory' and has_frame_handlers(frame_processors)
+    # worker processes share frames through an on-disk frame store instead of the decode pipe
+    streamable = not modules.globals.keep_frames and not modules.globals.map_faces and not resumable and modules.globals.execution_backend == 'thread' and has_frame_handlers(frame_processors)
+    segments = []
+    if modules.globals.video_segments > 1 and streamable:
+        segments = get_video_segments(modules.globals.target_path, modules.globals.video_segments)
+    if len(segments) > 1:
+        update_status('Creating temp resources...')
+        create_temp(modules.globals.target_path)
+        update_status(f'Processing {len(segments)} segments with {fps} fps...')
+        segment_paths = process_video_segments(segments, detect_resolution(modules.globals.target_path), fps)
+        update_status('Joining segments...')
+        if not concat_videos(modules.globals.target_path, segment_paths, mux_audio) and mux_audio:
+            mux_audio = False
+            concat_videos(modules.globals.target_path, segment_paths)
+    elif streamable:
+        update_status('Creating temp resources...')
+        create_temp(modules.globals.target_path)
+        update_status(f'Streaming video with {fps} fps...')
+        video_writer = create_video_writer(modules.globals.target_path, detect_resolution(modules.globals.target_path), fps, mux_audio)
+        try:
+            process_frame_stream(stream_frames(modules.globals.target_path), frame_processors, lambda frame_number, temp_frame: write_video_frame(video_writer, temp_frame), detect_frame_total(modules.globals.target_path))
+        finally:
+            if not close_video_writer(video_writer):
+                update_status('Encoding video failed!')
+        release_resources()
     else:
-        update_status('Creating video with 30.0 fps...')
-        create_video(modules.globals.target_path)
+        frame_store = get_frame_store(modules.globals.target_path)
+        if resumable and is_job_resumable(modules.globals.target_path, frame_store.get_frame_total()):
+            update_status('Resuming job...')
+        elif not modules.globals.map_faces or not take_analysis_frames(modules.globals.target_path):
+            # only frames freshly extracted by the face analysis are reused, earlier runs may have swapped them
+            update_status('Creating temp resources...')
+            create_temp(modules.globals.target_path)
+            update_status('Extracting frames...')
+            frame_store.extract()
+            if resumable:
+                create_job_manifest(modules.globals.target_path, frame_store.get_frame_total())
+
+        if not has_frame_handlers(frame_processors):
+            temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+            for frame_processor in frame_processors:
+                update_status('Progressing...', frame_processor.NAME)
+                frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+                release_resources()
+        elif modules.globals.fuse_frame_processors:
+            # read and write each frame once for the whole processor chain
+            update_status('Progressing...', ' + '.join(frame_processor.NAME for frame_processor in frame_processors))
+            if modules.globals.map_faces and modules.globals.many_faces:
+                update_status('Many faces enabled. Using first source image. Progressing...')
+            pass_name = '+'.join(modules.globals.frame_processors) if resumable else None
+            process_frame_store(frame_store, frame_processors, pass_name)
+            release_resources()
+        else:
+            for frame_processor in frame_processors:
+                update_status('Progressing...', frame_processor.NAME)
+                pass_name = frame_processor.NAME if resumable else None
+                process_frame_store(frame_store, [frame_processor], pass_name)
+                release_resources()
+        update_status(f'Creating video with {fps} fps...')
+        if not frame_store.create_video(fps, mux_audio) and mux_audio:
+            mux_audio = False
+            frame_store.create_video(fps)
     # handle audio
-    if modules.globals.keep_audio:
+    if mux_audio:
+        move_temp(modules.globals.target_path, modules.globals.output_path)
+    elif modules.globals.keep_audio:
         if modules.globals.keep_fps:
             update_status('Restoring audio...')
         else:
@@ -227,15 +368,49 @@ def start() -> None:
     else:
         move_temp(modules.globals.target_path, modules.globals.output_path)
     # clean and validate
+    close_job_manifest()
+    release_frame_store(modules.globals.target_path)
     clean_temp(modules.globals.target_path)
     if is_video(modules.globals.target_path):
         update_status('Processing to video succeed!')
     else:
         update_status('Processing to video failed!')
+    write_job_report(start_time)
+
+
+def start_batch() -> None:
+    batch_jobs = modules.globals.batch_jobs
+    failed_total = 0
+    # models stay loaded between jobs, the next job's files are read ahead meanwhile
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for index, (source_path, target_path, output_path) in enumerate(batch_jobs):
+            if index + 1 < len(batch_jobs):
+                next_source_path, next_target_path, _ = batch_jobs[index + 1]
+                executor.submit(prefetch_file, next_source_path)
+                executor.submit(prefetch_file, next_target_path)
+            modules.globals.source_path = source_path
+            modules.globals.target_path = target_path
+            modules.globals.output_path = output_path
+            update_status(f'Processing job {index + 1} of {len(batch_jobs)}: {target_path}')
+            # a broken target fails its own job only, the batch carries on with the next one
+            try:
+                start()
+            except Exception as exception:
+                failed_total += 1
+                update_status(f'Processing job {index + 1} failed: {exception}')
+                close_job_manifest()
+                if not modules.globals.resume:
+                    release_frame_store(target_path)
+                    clean_temp(target_path)
+    update_status(f'Processed {len(batch_jobs) - failed_total} jobs, {failed_total} failed!' if failed_total else f'Processed {len(batch_jobs)} jobs!')
 
 
 def destroy(to_quit=True) -> None:
-    if modules.globals.target_path:
+    close_job_manifest()
+    flush_profile()
+    # keep the frames and job manifest of an interrupted job for the next run
+    if modules.globals.target_path and not modules.globals.resume:
+        release_frame_store(modules.globals.target_path)
         clean_temp(modules.globals.target_path)
     if to_quit: quit()
 
@@ -248,8 +423,17 @@ def run() -> None:
         if not frame_processor.pre_check():
             return
     limit_resources()
-    if modules.globals.headless:
-        start()
+    if modules.globals.autotune:
+        update_status('Autotuning execution settings...')
+        tuned_config = autotune()
+        if tuned_config:
+            update_status(f"Tuned to {tuned_config['execution_threads']} execution threads and {tuned_config['intra_op_threads']} intra-op threads ({tuned_config['fps']:.2f} fps)")
+    if modules.globals.headless and modules.globals.batch_jobs:
+        with profile():
+            start_batch()
+    elif modules.globals.headless:
+        with profile():
+            start()
     else:
-        window = ui.init(start, destroy)
+        window = ui.init(profiled(start), destroy)
         window.mainloop()
@@ -1,42 +1,253 @@
+import copy
+import glob
+import hashlib
+import json
 import os
 import shutil
-from typing import Any
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 import insightface
+from insightface.utils import face_align
+from insightface.model_zoo.retinaface import distance2bbox, distance2kps
 
 import cv2
 import numpy as np
 import modules.globals
 from tqdm import tqdm
-from modules.typing import Frame
-from modules.cluster_analysis import find_cluster_centroids, find_closest_centroid
-from modules.utilities import get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths
+from modules.metrics import measure
+from modules.typing import Face, Frame
+from modules.session_pool import get_session, load_model
+from modules.cluster_analysis import find_cluster_centroids
+from modules.utilities import get_temp_directory_path, create_temp, clean_temp, resolve_relative_path, get_content_hash, detect_keyframe_numbers
+from modules.frame_store import get_frame_store, release_frame_store, prefetch_frames
+from modules.face_track_store import FaceTrackStore, create_face_track_store, load_face_track_store
+from modules.capturer import get_video_reader, release_video_reader
 from pathlib import Path
 
-FACE_ANALYSER = None
+# models each profile runs on top of the detector, swapping only needs the detected keypoints
+ANALYSER_PROFILES = {
+    'detection': ['detection'],
+    'recognition': ['detection', 'recognition'],
+    'full': None
+}
+DET_SIZES = [320, 480, 640, 800, 960, 1280]
+DEFAULT_DET_SIZE = 640
+# smallest face in detector pixels that is still found reliably
+MIN_DET_FACE_SIZE = 32
+# faces in front of a webcam take up a large part of the frame
+LIVE_FACE_SCALE = 0.2
+SOURCE_FACE_DIRECTORY = resolve_relative_path('../models/source-faces')
+SOURCE_FACE_FIELDS = ['bbox', 'kps', 'det_score', 'embedding']
+SOURCE_FACES: Dict[str, Any] = {}
+SOURCE_FACE_KEYS: Dict[Any, Tuple[str, Frame]] = {}
+SOURCE_FACES_LOCK = threading.Lock()
+FACE_ANALYSIS_VERSION = 1
+FACE_ANALYSIS_FRAMES_FILE = 'faces.key'
+MAX_CLUSTERS = 10
+
+
+def create_face_analyser(session_options: Any) -> Any:
+    # FaceAnalysis loads its models without session options, so the same set is loaded here with them instead
+    face_analyser = insightface.app.FaceAnalysis.__new__(insightface.app.FaceAnalysis)
+    face_analyser.model_dir = insightface.utils.ensure_available('models', 'buffalo_l')
+    face_analyser.models = {}
+    for model_file in sorted(glob.glob(os.path.join(face_analyser.model_dir, '*.onnx'))):
+        model = load_model(model_file, session_options)
+        if model is not None and model.taskname not in face_analyser.models:
+            face_analyser.models[model.taskname] = model
+    face_analyser.det_model = face_analyser.models['detection']
+    face_analyser.prepare(ctx_id=0, det_size=(DEFAULT_DET_SIZE, DEFAULT_DET_SIZE))
+    return face_analyser
+
+
+def create_face_analyser_profile(face_analyser: Any, profile: str, det_size: int) -> Any:
+    # shallow copies share the loaded sessions, they only narrow the models run per face and resize the detector input
+    face_analyser_profile = copy.copy(face_analyser)
+    face_analyser_profile.det_model = copy.copy(face_analyser.det_model)
+    face_analyser_profile.det_model.input_size = (det_size, det_size)
+    face_analyser_profile.models = {taskname: face_analyser_profile.det_model if taskname == 'detection' else model for taskname, model in face_analyser.models.items() if ANALYSER_PROFILES[profile] is None or taskname in ANALYSER_PROFILES[profile]}
+    return face_analyser_profile
+
+
+def get_face_analyser(profile: str = 'full', det_size: int = DEFAULT_DET_SIZE) -> Any:
+    face_analyser = get_session('face_analyser', create_face_analyser)
+    if ANALYSER_PROFILES[profile] is None and det_size == DEFAULT_DET_SIZE:
+        return face_analyser
+    # every profile and size bucket stays pooled, so switching between them costs nothing after the first call
+    return get_session(f'face_analyser.{profile}.{det_size}', lambda session_options: create_face_analyser_profile(face_analyser, profile, det_size))
+
+
+def get_det_size(frame: Frame) -> int:
+    if modules.globals.det_size != 'auto':
+        return int(modules.globals.det_size)
+    face_scale = LIVE_FACE_SCALE if modules.globals.webcam_preview_running else modules.globals.face_scale
+    # large enough for the smallest expected face, never larger than the frame itself
+    det_size = min(max(frame.shape[:2]), MIN_DET_FACE_SIZE / face_scale)
+    return next((size for size in DET_SIZES if size >= det_size), DET_SIZES[-1])
+
+
+def get_one_face(frame: Frame, profile: str = 'full') -> Any:
+    with measure('analyse'):
+        face = get_face_analyser(profile, get_det_size(frame)).get(frame)
+    try:
+        return min(face, key=lambda x: x.bbox[0])
+    except ValueError:
+        return None
 
 
-def get_face_analyser() -> Any:
-    global FACE_ANALYSER
+def get_many_faces(frame: Frame, profile: str = 'full') -> Any:
+    try:
+        with measure('analyse'):
+            return get_face_analyser(profile, get_det_size(frame)).get(frame)
+    except IndexError:
+        return None
 
-    if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
-    return FACE_ANALYSER
 
+def create_det_frame(frame: Frame, det_size: int) -> Tuple[Frame, float]:
+    # the same letterbox as RetinaFace.detect for a square input
+    frame_ratio = frame.shape[0] / frame.shape[1]
+    if frame_ratio > 1:
+        height, width = det_size, int(det_size / frame_ratio)
+    else:
+        height, width = int(det_size * frame_ratio), det_size
+    det_frame = np.zeros((det_size, det_size, 3), dtype=np.uint8)
+    det_frame[:height, :width] = cv2.resize(frame, (width, height))
+    return det_frame, height / frame.shape[0]
 
-def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+
+def run_det_model_batch(det_model: Any, frames: List[Frame]) -> Any:
+    det_size = det_model.input_size[0]
+    # frames of one shape share the letterbox scale
+    det_frames, det_scales = zip(*[create_det_frame(frame, det_size) for frame in frames])
+    blob = cv2.dnn.blobFromImages(det_frames, 1.0 / det_model.input_std, (det_size, det_size), (det_model.input_mean, det_model.input_mean, det_model.input_mean), swapRB=True)
     try:
-        return min(face, key=lambda x: x.bbox[0])
-    except ValueError:
+        outputs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+    except Exception:
+        return None
+    if getattr(det_model, 'batched', False):
+        return [[output[index] for output in outputs] for index in range(len(frames))], det_scales[0]
+    # models without a batch axis concatenate the anchors of every frame
+    if any(len(output) % len(frames) for output in outputs):
+        return None
+    return [list(frame_outputs) for frame_outputs in zip(*[np.split(output, len(frames)) for output in outputs])], det_scales[0]
+
+
+def get_anchor_centers(det_model: Any, size: int, stride: int) -> Any:
+    key = (size, size, stride)
+    if key not in det_model.center_cache:
+        anchor_centers = (np.stack(np.mgrid[:size, :size][::-1], axis=-1).astype(np.float32) * stride).reshape(-1, 2)
+        if det_model._num_anchors > 1:
+            anchor_centers = np.stack([anchor_centers] * det_model._num_anchors, axis=1).reshape(-1, 2)
+        det_model.center_cache[key] = anchor_centers
+    return det_model.center_cache[key]
+
+
+def decode_det_outputs(det_model: Any, outputs: List[Any], det_scale: float) -> Tuple[Any, Any]:
+    # the anchor decode and nms of RetinaFace.forward and detect, the letterbox and blob were made once for the batch
+    det_size = det_model.input_size[0]
+    feature_maps = det_model.fmc
+    scores_list, bboxes_list, kpss_list = [], [], []
+    for index, stride in enumerate(det_model._feat_stride_fpn):
+        anchor_centers = get_anchor_centers(det_model, det_size // stride, stride)
+        scores = outputs[index].reshape(-1)
+        positive_indices = np.where(scores >= det_model.det_thresh)[0]
+        scores_list.append(scores[positive_indices])
+        bboxes_list.append(distance2bbox(anchor_centers, outputs[index + feature_maps].reshape(-1, 4) * stride)[positive_indices])
+        if det_model.use_kps:
+            kpss = distance2kps(anchor_centers, outputs[index + feature_maps * 2].reshape(-1, 10) * stride)
+            kpss_list.append(kpss.reshape(kpss.shape[0], -1, 2)[positive_indices])
+    scores = np.concatenate(scores_list)
+    order = scores.argsort()[::-1]
+    pre_det = np.hstack((np.vstack(bboxes_list) / det_scale, scores[:, None])).astype(np.float32, copy=False)[order]
+    keep = det_model.nms(pre_det)
+    kpss = (np.vstack(kpss_list) / det_scale)[order][keep] if det_model.use_kps else None
+    return pre_det[keep], kpss
+
+
+def detect_faces_batch(det_model: Any, frames: List[Frame]) -> List[Any]:
+    batch_result = None
+    if len(frames) > 1 and all(frame.shape == frames[0].shape for frame in frames):
+        batch_result = run_det_model_batch(det_model, frames)
+    if batch_result is None:
+        return [det_model.detect(frame, max_num=0, metric='default') for frame in frames]
+    batch_outputs, det_scale = batch_result
+    return [decode_det_outputs(det_model, frame_outputs, det_scale) for frame_outputs in batch_outputs]
+
+
+def recognise_faces_batch(rec_model: Any, frames: List[Frame], many_faces: List[List[Face]]) -> None:
+    faces = [(frame, face) for frame, frame_faces in zip(frames, many_faces) for face in frame_faces]
+    if not faces:
+        return
+    crops = [face_align.norm_crop(frame, landmark=face.kps, image_size=rec_model.input_size[0]) for frame, face in faces]
+    try:
+        embeddings = rec_model.get_feat(crops)
+    except Exception:
+        # models exported with a fixed batch of one get a call per face
+        embeddings = np.concatenate([rec_model.get_feat([crop]) for crop in crops])
+    for (_, face), embedding in zip(faces, embeddings):
+        face.embedding = embedding.flatten()
+
+
+def get_many_faces_batch(frames: List[Frame], profile: str = 'full') -> List[List[Face]]:
+    with measure('analyse_batch'):
+        face_analyser = get_face_analyser(profile, get_det_size(frames[0]))
+        many_faces = []
+        # one detector call for all frames and one recognition call for all their faces
+        for bboxes, kpss in detect_faces_batch(face_analyser.det_model, frames):
+            many_faces.append([Face(bbox=bboxes[index, 0:4], kps=kpss[index] if kpss is not None else None, det_score=bboxes[index, 4]) for index in range(bboxes.shape[0])])
+        for taskname, model in face_analyser.models.items():
+            if taskname == 'recognition':
+                recognise_faces_batch(model, frames, many_faces)
+            elif taskname != 'detection':
+                for frame, frame_faces in zip(frames, many_faces):
+                    for face in frame_faces:
+                        model.get(frame, face)
+    return many_faces
+
+
+def get_source_face_key(source_path: str) -> Tuple[str, Frame]:
+    stat = os.stat(source_path)
+    file_key = (os.path.abspath(source_path), stat.st_size, stat.st_mtime)
+    if file_key not in SOURCE_FACE_KEYS:
+        with open(source_path, 'rb') as source_file:
+            content_hash = hashlib.sha256(source_file.read()).hexdigest()
+        SOURCE_FACE_KEYS[file_key] = (content_hash, cv2.imread(source_path))
+    content_hash, source_frame = SOURCE_FACE_KEYS[file_key]
+    # the detector size resolved for the image decides which face is found, the live preview resolves a different one
+    return f'{content_hash}-{get_det_size(source_frame)}', source_frame
+
+
+def load_source_face(source_face_path: str) -> Any:
+    try:
+        with np.load(source_face_path) as source_face_file:
+            return Face(**{field: source_face_file[field] for field in SOURCE_FACE_FIELDS})
+    except (OSError, ValueError, KeyError):
         return None
 
 
-def get_many_faces(frame: Frame) -> Any:
-    try:
-        return get_face_analyser().get(frame)
-    except IndexError:
+def save_source_face(source_face_path: str, source_face: Face) -> None:
+    os.makedirs(SOURCE_FACE_DIRECTORY, exist_ok=True)
+    # the normed embedding is derived from the embedding by the face itself
+    partial_source_face_path = source_face_path + '.partial.npz'
+    np.savez(partial_source_face_path, normed_embedding=source_face.normed_embedding, **{field: np.asarray(source_face[field]) for field in SOURCE_FACE_FIELDS})
+    os.replace(partial_source_face_path, source_face_path)
+
+
+def get_source_face(source_path: str) -> Any:
+    if not source_path or not os.path.isfile(source_path):
         return None
+    with SOURCE_FACES_LOCK:
+        source_face_key, source_frame = get_source_face_key(source_path)
+        if source_face_key not in SOURCE_FACES:
+            source_face_path = os.path.join(SOURCE_FACE_DIRECTORY, source_face_key + '.npz')
+            source_face = load_source_face(source_face_path)
+            if source_face is None:
+                source_face = get_one_face(source_frame, 'recognition')
+                if source_face is not None:
+                    save_source_face(source_face_path, source_face)
+            SOURCE_FACES[source_face_key] = source_face
+        return SOURCE_FACES[source_face_key]
+
 
 def has_valid_map() -> bool:
     for map in modules.globals.souce_target_map:
@@ -77,7 +288,7 @@ def get_unique_faces_from_target_image() -> Any:
     try:
         modules.globals.souce_target_map = []
         target_frame = cv2.imread(modules.globals.target_path)
-        many_faces = get_many_faces(target_frame)
+        many_faces = get_many_faces(target_frame, 'recognition')
         i = 0
 
         for face in many_faces:
@@ -94,81 +305,148 @@ def get_unique_faces_from_target_image() -> Any:
         return None
     
     
-def get_unique_faces_from_target_video() -> Any:
-    try:
-        modules.globals.souce_target_map = []
-        frame_face_embeddings = []
-        face_embeddings = []
-    
-        print('Creating temp resources...')
-        clean_temp(modules.globals.target_path)
-        create_temp(modules.globals.target_path)
-        print('Extracting frames...')
-        extract_frames(modules.globals.target_path)
+def get_face_analysis_path(target_path: str) -> str:
+    # beside the temp directory of the target, so cleaning the temp frames keeps it
+    target_name, _ = os.path.splitext(os.path.basename(target_path))
+    return os.path.join(os.path.dirname(get_temp_directory_path(target_path)), f'{target_name}.faces.npz')
 
-        temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
 
-        i = 0
-        for temp_frame_path in tqdm(temp_frame_paths, desc="Extracting face embeddings from frames"):
-            temp_frame = cv2.imread(temp_frame_path)
-            many_faces = get_many_faces(temp_frame)
+def get_face_analysis_key(target_path: str) -> str:
+    settings = {
+        'target': get_content_hash(target_path),
+        'version': FACE_ANALYSIS_VERSION,
+        'det_size': modules.globals.det_size,
+        'face_scale': modules.globals.face_scale,
+        'sample_interval': modules.globals.map_faces_sample_interval
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
 
-            for face in many_faces:
-                face_embeddings.append(face.normed_embedding)
-            
-            frame_face_embeddings.append({'frame': i, 'faces': many_faces, 'location': temp_frame_path})
-            i += 1
+def get_face_analysis_frames_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), FACE_ANALYSIS_FRAMES_FILE)
 
-        centroids = find_cluster_centroids(face_embeddings)
 
-        for frame in frame_face_embeddings:
-            for face in frame['faces']:
-                closest_centroid_index, _ = find_closest_centroid(centroids, face.normed_embedding)
-                face['target_centroid'] = closest_centroid_index
+def has_analysis_frames(target_path: str, face_analysis_key: str) -> bool:
+    # the extracted frames are only the unprocessed target while the marker written by the analysis is there
+    try:
+        with open(get_face_analysis_frames_path(target_path)) as face_analysis_frames_file:
+            return face_analysis_frames_file.read() == face_analysis_key
+    except OSError:
+        return False
+
+
+def take_analysis_frames(target_path: str) -> bool:
+    # frames are swapped in place once processing starts, so the marker vouches for them only once
+    if not has_analysis_frames(target_path, get_face_analysis_key(target_path)):
+        return False
+    os.remove(get_face_analysis_frames_path(target_path))
+    return True
+
+
+def analyse_target_video(face_analysis_key: str) -> FaceTrackStore:
+    print('Creating temp resources...')
+    release_frame_store(modules.globals.target_path)
+    clean_temp(modules.globals.target_path)
+    create_temp(modules.globals.target_path)
+    print('Extracting frames...')
+    frame_store = get_frame_store(modules.globals.target_path)
+    frame_store.extract()
+    with open(get_face_analysis_frames_path(modules.globals.target_path), 'w') as face_analysis_frames_file:
+        face_analysis_frames_file.write(face_analysis_key)
+    frame_total = frame_store.get_frame_total()
+    frame_numbers = range(frame_total)
+    if modules.globals.map_faces_sample_interval > 1:
+        # the sample is read from the extracted frames, so its frame numbers are the ones the swap pass looks up
+        frame_numbers = get_sample_frame_numbers(detect_keyframe_numbers(modules.globals.target_path), frame_total, modules.globals.map_faces_sample_interval)
+    # frames are read ahead on io threads while the models work on the previous batch
+    face_track_store = create_face_track_store(analyse_frames(prefetch_frames(frame_store, frame_numbers), len(frame_numbers)), frame_total)
+    face_track_store.assign_clusters(find_target_centroids(face_track_store.embeddings))
+    return face_track_store
+
+
+def find_target_centroids(embeddings: Any) -> Any:
+    # kmeans needs at least as many faces as clusters, a single face is its own identity
+    if len(embeddings) == 1:
+        return embeddings
+    return find_cluster_centroids(embeddings, min(MAX_CLUSTERS, len(embeddings)))
+
+
+def get_sample_frame_numbers(keyframes: List[int], frame_total: int, sample_interval: int) -> List[int]:
+    # keyframes mark most scene cuts, the interval covers long shots
+    sample_frame_numbers = set(range(0, frame_total, sample_interval))
+    sample_frame_numbers.update(keyframe for keyframe in keyframes if keyframe < frame_total)
+    return sorted(sample_frame_numbers)
+
+
+def analyse_frames(frames: Iterable[Tuple[int, Frame]], frame_total: int) -> Iterator[Tuple[int, List[Face]]]:
+    batch_size = max(1, modules.globals.analysis_batch_size)
+    batch = []
+    with tqdm(total=frame_total, desc="Extracting face embeddings from frames") as progress:
+        for frame_number, frame in frames:
+            if frame is None:
+                continue
+            batch.append((frame_number, frame))
+            if len(batch) == batch_size:
+                yield from zip([frame_number for frame_number, _ in batch], get_many_faces_batch([frame for _, frame in batch], 'recognition'))
+                progress.update(len(batch))
+                batch = []
+        if batch:
+            yield from zip([frame_number for frame_number, _ in batch], get_many_faces_batch([frame for _, frame in batch], 'recognition'))
+            progress.update(len(batch))
+
+
+def read_target_frame(frame_number: int, face_analysis_key: str) -> Frame:
+    # frames left by an earlier run may already be swapped, so only frames extracted for this analysis are read
+    if has_analysis_frames(modules.globals.target_path, face_analysis_key):
+        return get_frame_store(modules.globals.target_path).read(frame_number)
+    return get_video_reader(modules.globals.target_path).read(frame_number)
+
+
+def get_unique_faces_from_target_video() -> Any:
+    try:
+        modules.globals.souce_target_map = []
+        face_analysis_path = get_face_analysis_path(modules.globals.target_path)
+        face_analysis_key = get_face_analysis_key(modules.globals.target_path)
+        face_track_store = load_face_track_store(face_analysis_path, face_analysis_key)
+
+        if face_track_store is not None:
+            print('Reusing face analysis...')
+        else:
+            face_track_store = analyse_target_video(face_analysis_key)
+            face_track_store.save(face_analysis_path, face_analysis_key)
+        modules.globals.face_track_store = face_track_store
+        centroids = face_track_store.centroids
 
         for i in range(len(centroids)):
             modules.globals.souce_target_map.append({
                 'id' : i
             })
 
-            temp = []
-            for frame in tqdm(frame_face_embeddings, desc=f"Mapping frame embeddings to centroids-{i}"):
-                temp.append({'frame': frame['frame'], 'faces': [face for face in frame['faces'] if face['target_centroid'] == i], 'location': frame['location']})
-
-            modules.globals.souce_target_map[i]['target_faces_in_frame'] = temp
-
-        # dump_faces(centroids, frame_face_embeddings)
-        default_target_face()
+        # dump_faces(centroids, face_track_store)
+        default_target_face(face_analysis_key)
+        # the popup crops may have opened a reader, its decoded frames are not needed any more
+        release_video_reader(modules.globals.target_path)
     except ValueError:
         return None
     
 
-def default_target_face():
+def default_target_face(face_analysis_key: str):
     for map in modules.globals.souce_target_map:
-        best_face = None
-        best_frame = None
-        for frame in map['target_faces_in_frame']:
-            if len(frame['faces']) > 0:
-                best_face = frame['faces'][0]
-                best_frame = frame
-                break
-
-        for frame in map['target_faces_in_frame']:
-            for face in frame['faces']:
-                if face['det_score'] > best_face['det_score']:
-                    best_face = face
-                    best_frame = frame
+        best_face = modules.globals.face_track_store.get_best_face(map['id'])
+        if best_face is None:
+            continue
+        best_frame, best_face = best_face
 
         x_min, y_min, x_max, y_max = best_face['bbox']
 
-        target_frame = cv2.imread(best_frame['location'])
+        target_frame = read_target_frame(best_frame, face_analysis_key)
         map['target'] = {
                         'cv2' : target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
                         'face' : best_face
                         }
 
 
-def dump_faces(centroids: Any, frame_face_embeddings: list):
+def dump_faces(centroids: Any, face_track_store: FaceTrackStore):
     temp_directory_path = get_temp_directory_path(modules.globals.target_path)
 
     for i in range(len(centroids)):
@@ -176,14 +454,13 @@ def dump_faces(centroids: Any, frame_face_embeddings: list):
             shutil.rmtree(temp_directory_path + f"/{i}")
         Path(temp_directory_path + f"/{i}").mkdir(parents=True, exist_ok=True)
 
-        for frame in tqdm(frame_face_embeddings, desc=f"Copying faces to temp/./{i}"):
-            temp_frame = cv2.imread(frame['location'])
+        for frame_number in tqdm(face_track_store.get_cluster_frames(i), desc=f"Copying faces to temp/./{i}"):
+            temp_frame = get_frame_store(modules.globals.target_path).read(frame_number)
 
             j = 0
-            for face in frame['faces']:
-                if face['target_centroid'] == i:
-                    x_min, y_min, x_max, y_max = face['bbox']
+            for face in face_track_store.get_faces(frame_number, i):
+                x_min, y_min, x_max, y_max = face['bbox']
 
-                    if temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)].size > 0:
-                        cv2.imwrite(temp_directory_path + f"/{i}/{frame['frame']}_{j}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
-                j += 1
\ No newline at end of file
+                if temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)].size > 0:
+                    cv2.imwrite(temp_directory_path + f"/{i}/{frame_number}_{j}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
+                j += 1
@@ -0,0 +1,100 @@
+from typing import Any, Iterable, List, Tuple
+import os
+import numpy
+
+from modules.typing import Face
+
+EMBEDDING_SIZE = 512
+
+
+class FaceTrackStore:
+    def __init__(self, frame_numbers: Any, bboxes: Any, kps: Any, det_scores: Any, embeddings: Any, frame_total: int, analysed_frames: Any = None) -> None:
+        # rows are sorted by frame, so the faces of a frame are one contiguous slice
+        order = numpy.argsort(frame_numbers, kind='stable')
+        self.frame_numbers = numpy.asarray(frame_numbers, dtype=numpy.int32)[order]
+        self.bboxes = numpy.asarray(bboxes, dtype=numpy.float32).reshape(-1, 4)[order]
+        self.kps = numpy.asarray(kps, dtype=numpy.float32).reshape(-1, 5, 2)[order]
+        self.det_scores = numpy.asarray(det_scores, dtype=numpy.float32)[order]
+        self.embeddings = numpy.asarray(embeddings, dtype=numpy.float32).reshape(len(order), -1)[order] if len(order) else numpy.zeros((0, EMBEDDING_SIZE), dtype=numpy.float32)
+        self.cluster_ids = numpy.full(len(order), -1, dtype=numpy.int32)
+        self.centroids = numpy.zeros((0, self.embeddings.shape[1]), dtype=numpy.float32)
+        self.frame_total = frame_total
+        self.frame_offsets = numpy.searchsorted(self.frame_numbers, numpy.arange(frame_total + 1))
+        # a sampled analysis only covers some frames, the others are assigned while swapping
+        self.analysed = numpy.ones(frame_total, dtype=bool)
+        if analysed_frames is not None:
+            self.analysed[:] = False
+            self.analysed[numpy.asarray(analysed_frames, dtype=numpy.int64)] = True
+
+    def __len__(self) -> int:
+        return len(self.frame_numbers)
+
+    def assign_clusters(self, centroids: Any) -> None:
+        # same rule as find_closest_centroid, for every face at once
+        self.centroids = numpy.asarray(centroids, dtype=numpy.float32)
+        if len(self):
+            self.cluster_ids = numpy.argmax(self.embeddings @ self.centroids.T, axis=1).astype(numpy.int32)
+
+    def is_analysed(self, frame_number: int) -> bool:
+        return 0 <= frame_number < self.frame_total and bool(self.analysed[frame_number])
+
+    def assign_faces(self, faces: List[Face]) -> List[Face]:
+        if faces and len(self.centroids):
+            cluster_ids = numpy.argmax(numpy.array([face.normed_embedding for face in faces], dtype=numpy.float32) @ self.centroids.T, axis=1)
+            for face, cluster_id in zip(faces, cluster_ids):
+                face.target_centroid = int(cluster_id)
+        return faces
+
+    def get_face(self, row: int) -> Face:
+        # the stored embedding is already normed, so normed_embedding returns it unchanged
+        return Face(bbox=self.bboxes[row], kps=self.kps[row], det_score=float(self.det_scores[row]), embedding=self.embeddings[row], target_centroid=int(self.cluster_ids[row]))
+
+    def get_faces(self, frame_number: int, cluster_id: int = None) -> List[Face]:
+        if frame_number < 0 or frame_number >= self.frame_total:
+            return []
+        rows = range(self.frame_offsets[frame_number], self.frame_offsets[frame_number + 1])
+        return [self.get_face(row) for row in rows if cluster_id is None or self.cluster_ids[row] == cluster_id]
+
+    def get_cluster_frames(self, cluster_id: int) -> List[int]:
+        return numpy.unique(self.frame_numbers[self.cluster_ids == cluster_id]).tolist()
+
+    def get_best_face(self, cluster_id: int) -> Any:
+        rows = numpy.flatnonzero(self.cluster_ids == cluster_id)
+        if not len(rows):
+            return None
+        row = rows[numpy.argmax(self.det_scores[rows])]
+        return int(self.frame_numbers[row]), self.get_face(row)
+
+    def save(self, face_track_store_path: str, key: str) -> None:
+        partial_face_track_store_path = face_track_store_path + '.partial.npz'
+        numpy.savez(partial_face_track_store_path, key=key, frame_total=self.frame_total, frame_numbers=self.frame_numbers, bboxes=self.bboxes, kps=self.kps, det_scores=self.det_scores, embeddings=self.embeddings, cluster_ids=self.cluster_ids, centroids=self.centroids, analysed=self.analysed)
+        os.replace(partial_face_track_store_path, face_track_store_path)
+
+
+def create_face_track_store(frame_faces: Iterable[Tuple[int, List[Face]]], frame_total: int) -> FaceTrackStore:
+    frame_numbers, bboxes, kps, det_scores, embeddings, analysed_frames = [], [], [], [], [], []
+    # only the columns are kept, the full faces of a frame are dropped once it is read
+    for frame_number, faces in frame_faces:
+        if frame_number < frame_total:
+            analysed_frames.append(frame_number)
+        for face in faces or []:
+            frame_numbers.append(frame_number)
+            bboxes.append(face.bbox)
+            kps.append(face.kps)
+            det_scores.append(face.det_score)
+            embeddings.append(face.normed_embedding)
+    return FaceTrackStore(frame_numbers, bboxes, kps, det_scores, embeddings, frame_total, analysed_frames)
+
+
+def load_face_track_store(face_track_store_path: str, key: str) -> Any:
+    try:
+        with numpy.load(face_track_store_path) as face_track_store_file:
+            if str(face_track_store_file['key']) != key:
+                return None
+            face_track_store = FaceTrackStore(face_track_store_file['frame_numbers'], face_track_store_file['bboxes'], face_track_store_file['kps'], face_track_store_file['det_scores'], face_track_store_file['embeddings'], int(face_track_store_file['frame_total']), numpy.flatnonzero(face_track_store_file['analysed']))
+            # rows were saved in frame order, so the cluster ids line up again
+            face_track_store.cluster_ids = face_track_store_file['cluster_ids']
+            face_track_store.centroids = face_track_store_file['centroids']
+            return face_track_store
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,103 @@
+from typing import Any, Callable, List
+import cv2
+import numpy
+
+import modules.globals
+from modules.typing import Face, Frame
+
+SCENE_CUT_SIZE = (64, 36)
+SCENE_CUT_THRESHOLD = 30.0
+MIN_TRACK_IOU = 0.3
+# forward-backward flow error allowed per keypoint, relative to the face width
+MAX_FLOW_ERROR = 0.02
+FLOW_PARAMS = {'winSize': (21, 21), 'maxLevel': 3, 'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)}
+
+
+def get_iou(bbox_a: Any, bbox_b: Any) -> float:
+    width = min(bbox_a[2], bbox_b[2]) - max(bbox_a[0], bbox_b[0])
+    height = min(bbox_a[3], bbox_b[3]) - max(bbox_a[1], bbox_b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / ((bbox_a[2] - bbox_a[0]) * (bbox_a[3] - bbox_a[1]) + (bbox_b[2] - bbox_b[0]) * (bbox_b[3] - bbox_b[1]) - intersection)
+
+
+class FaceTracker:
+    def __init__(self, interval: int = None) -> None:
+        self.interval = interval or modules.globals.face_tracker_interval
+        self.faces: List[Face] = []
+        self.previous_gray = None
+        self.previous_thumbnail = None
+        self.frame_number = -1
+        self.frames_since_detection = 0
+        self.next_track_id = 0
+
+    def track(self, frame: Frame, detect: Callable[[Frame], List[Face]], frame_number: int = None) -> List[Face]:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, SCENE_CUT_SIZE, interpolation=cv2.INTER_AREA)
+        faces = None
+        # carry the faces forward only between consecutive frames of the same shot
+        if self.faces and self.frames_since_detection < self.interval and self.is_next_frame(frame_number) and not self.is_scene_cut(thumbnail):
+            faces = self.propagate(gray)
+        if faces is None:
+            faces = self.match(detect(frame) or [])
+            self.frames_since_detection = 0
+        self.faces = faces
+        self.previous_gray = gray
+        self.previous_thumbnail = thumbnail
+        self.frame_number = frame_number if frame_number is not None else self.frame_number + 1
+        self.frames_since_detection += 1
+        return faces
+
+    def is_next_frame(self, frame_number: int) -> bool:
+        return frame_number is None or frame_number == self.frame_number + 1
+
+    def is_scene_cut(self, thumbnail: Frame) -> bool:
+        return self.previous_thumbnail is None or self.previous_thumbnail.shape != thumbnail.shape or float(cv2.absdiff(self.previous_thumbnail, thumbnail).mean()) > SCENE_CUT_THRESHOLD
+
+    def propagate(self, gray: Frame) -> Any:
+        if self.previous_gray.shape != gray.shape:
+            return None
+        points = numpy.concatenate([face.kps for face in self.faces]).astype(numpy.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points, None, **FLOW_PARAMS)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, next_points, None, **FLOW_PARAMS)
+        flow_errors = numpy.linalg.norm(points - back_points, axis=2).reshape(-1)
+        tracked = (status.reshape(-1) == 1) & (back_status.reshape(-1) == 1)
+        faces = []
+        for face_index, face in enumerate(self.faces):
+            point_slice = slice(face_index * 5, face_index * 5 + 5)
+            max_flow_error = max(1.0, (face.bbox[2] - face.bbox[0]) * MAX_FLOW_ERROR)
+            # a lost keypoint means low confidence, the caller falls back to detection
+            if not tracked[point_slice].all() or flow_errors[point_slice].max() > max_flow_error:
+                return None
+            kps = next_points[point_slice].reshape(5, 2)
+            matrix, _ = cv2.estimateAffinePartial2D(face.kps.astype(numpy.float32), kps)
+            if matrix is None:
+                return None
+            x_min, y_min, x_max, y_max = face.bbox
+            corners = cv2.transform(numpy.array([[[x_min, y_min], [x_max, y_min], [x_min, y_max], [x_max, y_max]]], dtype=numpy.float32), matrix)[0]
+            tracked_face = Face(face)
+            tracked_face.kps = kps
+            tracked_face.bbox = numpy.concatenate([corners.min(axis=0), corners.max(axis=0)])
+            faces.append(tracked_face)
+        return faces
+
+    def match(self, faces: List[Face]) -> List[Face]:
+        # detections keep the track id of the face they overlap most, new faces get a new one
+        unmatched_faces = list(self.faces)
+        for face in faces:
+            best_face = max(unmatched_faces, key=lambda previous_face: get_iou(face.bbox, previous_face.bbox), default=None)
+            if best_face is not None and get_iou(face.bbox, best_face.bbox) >= MIN_TRACK_IOU:
+                face.track_id = best_face.track_id
+                unmatched_faces.remove(best_face)
+            else:
+                face.track_id = self.next_track_id
+                self.next_track_id += 1
+        return faces
+
+
+def create_face_tracker() -> Any:
+    # frames must reach the tracker in order, which only a single execution thread guarantees
+    if modules.globals.face_tracker_interval > 1 and modules.globals.execution_threads == 1:
+        return FaceTracker()
+    return None
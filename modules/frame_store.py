@@ -0,0 +1,210 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import cv2
+import numpy
+
+import modules.globals
+from modules.metrics import measure
+from modules.typing import Frame
+from modules.utilities import detect_resolution, extract_frames, stream_frames, create_video, create_video_writer, write_video_frame, close_video_writer, get_temp_directory_path, get_temp_frame_paths, get_temp_frame_path
+
+FRAME_STORES: Dict[str, Any] = {}
+FRAME_STORE_FILE = 'frames.raw'
+FRAME_STORE_META_FILE = 'frames.json'
+
+
+class FrameStore:
+    shareable = True
+
+    def __init__(self, target_path: str) -> None:
+        self.target_path = target_path
+
+    def extract(self) -> None:
+        raise NotImplementedError
+
+    def read(self, frame_number: int) -> Frame:
+        raise NotImplementedError
+
+    def write(self, frame_number: int, frame: Frame) -> None:
+        raise NotImplementedError
+
+    def get_frame_total(self) -> int:
+        raise NotImplementedError
+
+    def get_pending_frame_path(self, frame_number: int, pass_name: str) -> str:
+        return os.path.join(get_temp_directory_path(self.target_path), f'.{pass_name}-{frame_number}.npy')
+
+    def write_pending(self, frame_number: int, frame: Frame, pass_name: str) -> None:
+        # a resumable pass keeps the source frame until the job log records the processed one
+        pending_frame_path = self.get_pending_frame_path(frame_number, pass_name)
+        partial_frame_path = pending_frame_path + '.partial.npy'
+        with measure('frame_write'):
+            numpy.save(partial_frame_path, frame)
+            os.replace(partial_frame_path, pending_frame_path)
+
+    def commit_pending(self, frame_number: int, pass_name: str) -> None:
+        # replaying a commit after an interruption writes the same frame again, so it is safe to repeat
+        pending_frame_path = self.get_pending_frame_path(frame_number, pass_name)
+        if os.path.isfile(pending_frame_path):
+            self.write(frame_number, numpy.load(pending_frame_path))
+            os.remove(pending_frame_path)
+
+    def create_video(self, fps: float = 30.0, mux_audio: bool = False) -> bool:
+        if not self.get_frame_total():
+            return False
+        height, width, _ = self.read(0).shape
+        video_writer = create_video_writer(self.target_path, (width, height), fps, mux_audio)
+        try:
+            for frame_number in range(self.get_frame_total()):
+                write_video_frame(video_writer, self.read(frame_number))
+        finally:
+            done = close_video_writer(video_writer)
+        return done
+
+    def release(self) -> None:
+        pass
+
+
+class PngFrameStore(FrameStore):
+    def extract(self) -> None:
+        extract_frames(self.target_path)
+
+    def read(self, frame_number: int) -> Frame:
+        with measure('frame_read'):
+            return cv2.imread(get_temp_frame_path(self.target_path, frame_number))
+
+    def write(self, frame_number: int, frame: Frame) -> None:
+        temp_frame_path = get_temp_frame_path(self.target_path, frame_number)
+        # write to a hidden file and replace atomically, an interrupted write must not destroy the frame
+        partial_frame_path = os.path.join(os.path.dirname(temp_frame_path), '.' + os.path.basename(temp_frame_path))
+        with measure('frame_write'):
+            if cv2.imwrite(partial_frame_path, frame):
+                os.replace(partial_frame_path, temp_frame_path)
+
+    def get_frame_total(self) -> int:
+        return len(get_temp_frame_paths(self.target_path))
+
+    def get_pending_frame_path(self, frame_number: int, pass_name: str) -> str:
+        temp_frame_path = get_temp_frame_path(self.target_path, frame_number)
+        return os.path.join(os.path.dirname(temp_frame_path), f'.{pass_name}-' + os.path.basename(temp_frame_path))
+
+    def write_pending(self, frame_number: int, frame: Frame, pass_name: str) -> None:
+        pending_frame_path = self.get_pending_frame_path(frame_number, pass_name)
+        partial_frame_path = os.path.join(os.path.dirname(pending_frame_path), '.partial' + os.path.basename(pending_frame_path))
+        with measure('frame_write'):
+            if cv2.imwrite(partial_frame_path, frame):
+                os.replace(partial_frame_path, pending_frame_path)
+
+    def commit_pending(self, frame_number: int, pass_name: str) -> None:
+        pending_frame_path = self.get_pending_frame_path(frame_number, pass_name)
+        if os.path.isfile(pending_frame_path):
+            os.replace(pending_frame_path, get_temp_frame_path(self.target_path, frame_number))
+
+    def create_video(self, fps: float = 30.0, mux_audio: bool = False) -> bool:
+        return create_video(self.target_path, fps, mux_audio)
+
+
+class MmapFrameStore(FrameStore):
+    def __init__(self, target_path: str) -> None:
+        super().__init__(target_path)
+        self.frames = None
+        self.frame_path = os.path.join(get_temp_directory_path(target_path), FRAME_STORE_FILE)
+        self.meta_path = os.path.join(get_temp_directory_path(target_path), FRAME_STORE_META_FILE)
+
+    def extract(self) -> None:
+        self.release()
+        width, height = detect_resolution(self.target_path)
+        frame_total = 0
+        with open(self.frame_path, 'wb') as frame_file:
+            for _, frame in stream_frames(self.target_path):
+                frame_file.write(frame.data)
+                frame_total += 1
+        with open(self.meta_path, 'w') as meta_file:
+            json.dump({'width': width, 'height': height, 'frame_total': frame_total}, meta_file)
+
+    def get_frames(self) -> Any:
+        if self.frames is None and os.path.isfile(self.meta_path):
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta['frame_total']:
+                self.frames = numpy.memmap(self.frame_path, dtype=numpy.uint8, mode='r+', shape=(meta['frame_total'], meta['height'], meta['width'], 3))
+        return self.frames
+
+    def read(self, frame_number: int) -> Frame:
+        with measure('frame_read'):
+            return numpy.array(self.get_frames()[frame_number])
+
+    def write(self, frame_number: int, frame: Frame) -> None:
+        with measure('frame_write'):
+            self.get_frames()[frame_number] = frame
+
+    def get_frame_total(self) -> int:
+        frames = self.get_frames()
+        return len(frames) if frames is not None else 0
+
+    def release(self) -> None:
+        if self.frames is not None:
+            self.frames.flush()
+            self.frames = None
+
+
+class MemoryFrameStore(FrameStore):
+    shareable = False
+
+    def __init__(self, target_path: str) -> None:
+        super().__init__(target_path)
+        self.frames: List[Frame] = []
+
+    def extract(self) -> None:
+        self.frames = [frame for _, frame in stream_frames(self.target_path)]
+
+    def read(self, frame_number: int) -> Frame:
+        return self.frames[frame_number]
+
+    def write(self, frame_number: int, frame: Frame) -> None:
+        self.frames[frame_number] = frame
+
+    def get_frame_total(self) -> int:
+        return len(self.frames)
+
+    def release(self) -> None:
+        self.frames = []
+
+
+FRAME_STORE_TYPES = {
+    'png': PngFrameStore,
+    'mmap': MmapFrameStore,
+    'memory': MemoryFrameStore
+}
+
+
+def get_frame_store(target_path: str) -> FrameStore:
+    frame_store_type = FRAME_STORE_TYPES[modules.globals.frame_store]
+    frame_store = FRAME_STORES.get(target_path)
+    if type(frame_store) is not frame_store_type:
+        release_frame_store(target_path)
+        frame_store = FRAME_STORES[target_path] = frame_store_type(target_path)
+    return frame_store
+
+
+def release_frame_store(target_path: str) -> None:
+    frame_store = FRAME_STORES.pop(target_path, None)
+    if frame_store:
+        frame_store.release()
+
+
+def prefetch_frames(frame_store: FrameStore, frame_numbers: Iterable[int]) -> Iterator[Tuple[int, Frame]]:
+    # reads run ahead on the decode threads, bounded by the frame queue size
+    with ThreadPoolExecutor(max_workers=max(1, modules.globals.decode_threads)) as executor:
+        pending: deque[Any] = deque()
+        for frame_number in frame_numbers:
+            pending.append((frame_number, executor.submit(frame_store.read, frame_number)))
+            if len(pending) >= modules.globals.frame_queue_size:
+                frame_number, future = pending.popleft()
+                yield frame_number, future.result()
+        while pending:
+            frame_number, future = pending.popleft()
+            yield frame_number, future.result()
@@ -11,14 +11,18 @@ file_types = [
 
 souce_target_map = []
 simple_map = {}
+face_track_store = None
 
 source_path = None
 target_path = None
 output_path = None
+batch_jobs: List[Any] = []
 frame_processors: List[str] = []
 keep_fps = None
 keep_audio = None
 keep_frames = None
+frame_store = 'png'
+resume = False
 many_faces = None
 map_faces = None
 color_correction = None  # New global variable for color correction toggle
@@ -30,6 +34,24 @@ live_resizable = None
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = None
+intra_op_threads = 0
+session_per_thread = False
+autotune = False
+execution_backend = 'thread'
+fuse_frame_processors = True
+decode_threads = 2
+write_threads = 2
+batch_size = 1
+frame_queue_size = 16
+video_segments = 1
+det_size = 'auto'
+face_scale = 0.05
+face_tracker_interval = 1
+analysis_batch_size = 8
+map_faces_sample_interval = 0
+metrics_report = False
+profile_path = None
+profile_interval = 5.0
 headless = None
 log_level = 'error'
 fp_ui: Dict[str, bool] = {}
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Set
+
+import modules.globals
+from modules.utilities import get_temp_directory_path
+
+JOB_MANIFEST_FILE = 'job.json'
+JOB_LOG_FILE = 'job.log'
+JOB_LOG = None
+JOB_LOG_LOCK = threading.Lock()
+
+
+def get_job_manifest_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), JOB_MANIFEST_FILE)
+
+
+def get_job_log_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), JOB_LOG_FILE)
+
+
+def get_file_fingerprint(file_path: str) -> Any:
+    if not file_path or not os.path.isfile(file_path):
+        return None
+    stat = os.stat(file_path)
+    return [os.path.abspath(file_path), stat.st_size, stat.st_mtime]
+
+
+def get_settings_hash() -> str:
+    settings = {
+        'source': get_file_fingerprint(modules.globals.source_path),
+        'target': get_file_fingerprint(modules.globals.target_path),
+        'frame_processors': modules.globals.frame_processors,
+        # fused and unfused runs record their passes under different names
+        'fuse_frame_processors': modules.globals.fuse_frame_processors,
+        'frame_store': modules.globals.frame_store,
+        'many_faces': modules.globals.many_faces,
+        'map_faces': modules.globals.map_faces,
+        'color_correction': modules.globals.color_correction,
+        'det_size': modules.globals.det_size,
+        'face_scale': modules.globals.face_scale,
+        'face_tracker_interval': modules.globals.face_tracker_interval
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def load_job_manifest(target_path: str) -> Dict[str, Any]:
+    try:
+        with open(get_job_manifest_path(target_path)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_job_resumable(target_path: str, frame_total: int) -> bool:
+    job_manifest = load_job_manifest(target_path)
+    return bool(frame_total) and job_manifest.get('settings_hash') == get_settings_hash() and job_manifest.get('frame_total') == frame_total
+
+
+def create_job_manifest(target_path: str, frame_total: int) -> None:
+    close_job_manifest()
+    job_log_path = get_job_log_path(target_path)
+    if os.path.isfile(job_log_path):
+        os.remove(job_log_path)
+    with open(get_job_manifest_path(target_path), 'w') as manifest_file:
+        json.dump({'settings_hash': get_settings_hash(), 'frame_processors': modules.globals.frame_processors, 'frame_total': frame_total}, manifest_file)
+
+
+def get_completed_frames(target_path: str, pass_name: str) -> Set[int]:
+    completed_frames = set()
+    try:
+        with open(get_job_log_path(target_path)) as job_log:
+            for line in job_log:
+                # the last line may be cut short by an interruption
+                line_pass_name, _, frame_number = line.strip().rpartition(' ')
+                if line_pass_name == pass_name and frame_number.isdigit():
+                    completed_frames.add(int(frame_number))
+    except OSError:
+        pass
+    return completed_frames
+
+
+def mark_frame_completed(target_path: str, pass_name: str, frame_number: int) -> None:
+    global JOB_LOG
+
+    with JOB_LOG_LOCK:
+        # line buffered, the log line is what lets the pending frame replace its source
+        if JOB_LOG is None:
+            JOB_LOG = open(get_job_log_path(target_path), 'a', buffering=1)
+        JOB_LOG.write(f'{pass_name} {frame_number}\n')
+
+
+def close_job_manifest() -> None:
+    global JOB_LOG
+
+    with JOB_LOG_LOCK:
+        if JOB_LOG:
+            JOB_LOG.close()
+            JOB_LOG = None
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+STAGES: Dict[str, Dict[str, Any]] = {}
+STAGES_LOCK = threading.Lock()
+STAGE_SAMPLES = 4096
+
+
+def record_stage(stage: str, duration: float) -> None:
+    with STAGES_LOCK:
+        if stage not in STAGES:
+            # percentiles come from the latest samples, totals cover the whole job
+            STAGES[stage] = {'count': 0, 'total': 0.0, 'samples': deque(maxlen=STAGE_SAMPLES)}
+        STAGES[stage]['count'] += 1
+        STAGES[stage]['total'] += duration
+        STAGES[stage]['samples'].append(duration)
+
+
+@contextmanager
+def measure(stage: str) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def reset_stages() -> None:
+    with STAGES_LOCK:
+        STAGES.clear()
+
+
+def get_percentile(samples: list, percentile: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))] if samples else 0.0
+
+
+def get_stage_report() -> Dict[str, Dict[str, float]]:
+    with STAGES_LOCK:
+        stages = {stage: (values['count'], values['total'], sorted(values['samples'])) for stage, values in STAGES.items()}
+    stage_report = {}
+    for stage, (count, total, samples) in stages.items():
+        stage_report[stage] = {
+            'count': count,
+            'total_s': round(total, 3),
+            'mean_ms': round(total / count * 1000, 3),
+            'p50_ms': round(get_percentile(samples, 50) * 1000, 3),
+            'p90_ms': round(get_percentile(samples, 90) * 1000, 3),
+            'p99_ms': round(get_percentile(samples, 99) * 1000, 3),
+            # calls per second of one caller, the stage scales with the threads running it
+            'fps': round(count / total, 2) if total else 0.0
+        }
+    return stage_report
+
+
+def get_stage_postfix() -> Dict[str, str]:
+    return {stage: f"{values['p50_ms']:.0f}/{values['p99_ms']:.0f}ms {values['fps']:.0f}fps" for stage, values in get_stage_report().items()}
+
+
+def write_stage_report(report_path: str, job: Dict[str, Any]) -> None:
+    with open(report_path, 'w') as report_file:
+        json.dump({**job, 'stages': get_stage_report()}, report_file, indent=4)
@@ -1,14 +1,57 @@
 import sys
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Dict, Iterable, Tuple
 from tqdm import tqdm
+import cv2
 
 import modules
 import modules.globals                   
+from modules.typing import Frame
+from modules.frame_store import FrameStore, get_frame_store
+from modules.job_manifest import get_completed_frames, mark_frame_completed
+from modules.metrics import get_stage_postfix
+from modules.session_pool import session_slot
+from modules.utilities import stream_frames, create_video_writer, write_video_frame, close_video_writer, get_temp_segment_path
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+PROCESS_FRAME_HANDLERS: List[Callable[[int, Frame], Frame]] = []
+PROGRESS_POSTFIX_INTERVAL = 1.0
+WORKER_GLOBALS = [
+    'source_path',
+    'target_path',
+    'frame_processors',
+    'keep_fps',
+    'keep_audio',
+    'many_faces',
+    'map_faces',
+    'color_correction',
+    'det_size',
+    'face_scale',
+    'face_tracker_interval',
+    'video_encoder',
+    'video_quality',
+    'max_memory',
+    'execution_providers',
+    'execution_threads',
+    'intra_op_threads',
+    'session_per_thread',
+    'video_segments',
+    'frame_queue_size',
+    'batch_size',
+    'frame_store',
+    'souce_target_map',
+    'simple_map',
+    'face_track_store',
+    'log_level',
+    'fp_ui'
+]
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
@@ -56,18 +99,303 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
                 pass
 
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
+    max_pending = modules.globals.execution_threads + modules.globals.frame_queue_size
     with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = []
+        pending: deque[Any] = deque()
         for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
-            futures.append(future)
-        for future in futures:
-            future.result()
+            pending.append(executor.submit(process_frames_in_session_slot, process_frames, source_path, [path], progress))
+            if len(pending) >= max_pending:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+
+
+def process_frames_in_session_slot(process_frames: Callable[[str, List[str], Any], None], source_path: str, temp_frame_paths: List[str], progress: Any) -> None:
+    with session_slot():
+        process_frames(source_path, temp_frame_paths, progress)
+
+
+def has_frame_handlers(frame_processors: List[ModuleType]) -> bool:
+    return all(hasattr(frame_processor, 'create_frame_handler') for frame_processor in frame_processors)
+
+
+def handle_frame(frame_handlers: List[Callable[[int, Frame], Frame]], frame_number: int, temp_frame: Frame) -> Frame:
+    for frame_handler in frame_handlers:
+        try:
+            temp_frame = frame_handler(frame_number, temp_frame)
+        except Exception as exception:
+            print(exception)
+    return temp_frame
+
+
+def wrap_frame_handlers(frame_handlers: List[Callable[[int, Frame], Frame]]) -> Callable[[List[int], List[Frame]], List[Frame]]:
+    return lambda frame_numbers, temp_frames: [handle_frame(frame_handlers, frame_number, temp_frame) for frame_number, temp_frame in zip(frame_numbers, temp_frames)]
+
+
+def create_batch_handler(frame_processors: List[ModuleType]) -> Callable[[List[int], List[Frame]], List[Frame]]:
+    frame_handlers = [frame_processor.create_frame_handler(modules.globals.source_path) for frame_processor in frame_processors]
+    # mapped faces are looked up per frame number, so they always go frame by frame
+    batch_processors = [frame_processor if hasattr(frame_processor, 'process_batch') and not modules.globals.map_faces else None for frame_processor in frame_processors]
+    batch_context: Dict[str, Any] = {'source_path': modules.globals.source_path}
+
+    def handle_batch(frame_numbers: List[int], temp_frames: List[Frame]) -> List[Frame]:
+        for batch_processor, frame_handler in zip(batch_processors, frame_handlers):
+            if batch_processor and len(temp_frames) > 1:
+                try:
+                    temp_frames = batch_processor.process_batch(temp_frames, batch_context)
+                    continue
+                except Exception as exception:
+                    print(exception)
+            temp_frames = [handle_frame([frame_handler], frame_number, temp_frame) for frame_number, temp_frame in zip(frame_numbers, temp_frames)]
+        return temp_frames
+
+    return handle_batch
+
+
+def run_stage(worker: Callable[[], None], worker_total: int, on_done: Callable[[], None]) -> List[threading.Thread]:
+    remaining = [worker_total]
+    lock = threading.Lock()
+
+    def run_worker() -> None:
+        try:
+            worker()
+        finally:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    on_done()
+
+    threads = [threading.Thread(target=run_worker, daemon=True) for _ in range(worker_total)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def process_frame_pipeline(items: Iterable[Any], decode_frame: Callable[[Any], Tuple[int, Frame]], handle_batch: Callable[[List[int], List[Frame]], List[Frame]], write_frame: Callable[[int, Frame], None], progress: Any, decode_threads: int = 1, write_threads: int = 1) -> None:
+    infer_threads = modules.globals.execution_threads
+    batch_size = max(1, modules.globals.batch_size)
+    queue_size = max(modules.globals.frame_queue_size, batch_size)
+    decode_queue: queue.Queue[Any] = queue.Queue(maxsize=queue_size)
+    infer_queue: queue.Queue[Any] = queue.Queue(maxsize=queue_size)
+    write_queue: queue.Queue[Any] = queue.Queue(maxsize=queue_size)
+    # caps decoded but unwritten frames, so the reorder buffer cannot grow behind a slow frame
+    in_flight = threading.Semaphore(queue_size * 3 + infer_threads * batch_size)
+    item_iterator = enumerate(items)
+    item_lock = threading.Lock()
+    errors: List[Exception] = []
+
+    def decode() -> None:
+        while True:
+            in_flight.acquire()
+            with item_lock:
+                item = next(item_iterator, None) if not errors else None
+            if item is None:
+                in_flight.release()
+                return
+            sequence, payload = item
+            try:
+                frame_number, temp_frame = decode_frame(payload)
+            except Exception as exception:
+                errors.append(exception)
+                frame_number, temp_frame = sequence, None
+            decode_queue.put((sequence, frame_number, temp_frame))
+
+    def infer() -> None:
+        with session_slot():
+            infer_frames()
+
+    def infer_frames() -> None:
+        running = True
+        while running:
+            item = decode_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # take what is already decoded, never wait for a batch to fill up
+            while len(batch) < batch_size:
+                try:
+                    item = decode_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            decoded = [item for item in batch if item[2] is not None]
+            if decoded:
+                temp_frames = handle_batch([item[1] for item in decoded], [item[2] for item in decoded])
+                for (sequence, frame_number, _), temp_frame in zip(decoded, temp_frames):
+                    infer_queue.put((sequence, frame_number, temp_frame))
+            for item in batch:
+                if item[2] is None:
+                    infer_queue.put(item)
+
+    def reorder() -> None:
+        reorder_buffer: Dict[int, Any] = {}
+        next_sequence = 0
+        while True:
+            item = infer_queue.get()
+            if item is None:
+                break
+            reorder_buffer[item[0]] = item
+            while next_sequence in reorder_buffer:
+                write_queue.put(reorder_buffer.pop(next_sequence))
+                next_sequence += 1
+        for sequence in sorted(reorder_buffer):
+            write_queue.put(reorder_buffer.pop(sequence))
+
+    def write() -> None:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            _, frame_number, temp_frame = item
+            try:
+                if temp_frame is not None:
+                    write_frame(frame_number, temp_frame)
+            except Exception as exception:
+                errors.append(exception)
+            finally:
+                in_flight.release()
+            update_progress(progress)
+
+    threads = run_stage(decode, decode_threads, lambda: [decode_queue.put(None) for _ in range(infer_threads)])
+    threads += run_stage(infer, infer_threads, lambda: infer_queue.put(None))
+    threads += run_stage(reorder, 1, lambda: [write_queue.put(None) for _ in range(write_threads)])
+    threads += run_stage(write, write_threads, lambda: None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def process_frame_stream(frames: Iterable[Tuple[int, Frame]], frame_processors: List[ModuleType], write_frame: Callable[[int, Frame], None], total: int = 0, position: int = 0) -> None:
+    # a pipe decodes sequentially and an encoder needs frames in order, so both ends keep one worker
+    with create_progress(total, position) as progress:
+        process_frame_pipeline(frames, lambda frame: frame, create_batch_handler(frame_processors), write_frame, progress)
+
 
+def process_frame_paths(frame_paths: List[str], frame_handlers: List[Callable[[int, Frame], Frame]]) -> None:
+    with create_progress(len(frame_paths)) as progress:
+        process_frame_pipeline(enumerate(frame_paths), lambda item: (item[0], cv2.imread(item[1])), wrap_frame_handlers(frame_handlers), lambda frame_number, temp_frame: cv2.imwrite(frame_paths[frame_number], temp_frame), progress, modules.globals.decode_threads, modules.globals.write_threads)
 
-def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+
+def process_frame_store(frame_store: FrameStore, frame_processors: List[ModuleType], pass_name: str = None) -> None:
+    frame_numbers: Iterable[int] = range(frame_store.get_frame_total())
+    if pass_name:
+        completed_frames = get_completed_frames(frame_store.target_path, pass_name)
+        # finish frames that were logged as completed but not yet committed when the job was interrupted
+        for frame_number in completed_frames:
+            frame_store.commit_pending(frame_number, pass_name)
+        frame_numbers = [frame_number for frame_number in frame_numbers if frame_number not in completed_frames]
+
+    def on_frame_written(frame_number: int) -> None:
+        # the source frame is only replaced after the log records the processed one, an interrupted frame is redone from its source
+        if pass_name:
+            mark_frame_completed(frame_store.target_path, pass_name, frame_number)
+            frame_store.commit_pending(frame_number, pass_name)
+
+    with create_progress(frame_store.get_frame_total()) as progress:
+        progress.update(frame_store.get_frame_total() - len(frame_numbers))
+        # an in-memory store cannot be shared with worker processes
+        if modules.globals.execution_backend == 'process' and frame_store.shareable:
+            multi_process_frame_store(frame_numbers, [frame_processor.__name__ for frame_processor in frame_processors], on_frame_written, progress, pass_name)
+            return
+
+        def write_frame(frame_number: int, temp_frame: Frame) -> None:
+            if pass_name:
+                frame_store.write_pending(frame_number, temp_frame, pass_name)
+            else:
+                frame_store.write(frame_number, temp_frame)
+            on_frame_written(frame_number)
+
+        process_frame_pipeline(frame_numbers, lambda frame_number: (frame_number, frame_store.read(frame_number)), create_batch_handler(frame_processors), write_frame, progress, modules.globals.decode_threads, modules.globals.write_threads)
+
+
+def init_process_worker(worker_globals: Dict[str, Any], frame_processor_names: List[str]) -> None:
+    global PROCESS_FRAME_HANDLERS
+
+    init_worker(worker_globals)
+    # every worker process loads its own analyser and swapper sessions once
+    PROCESS_FRAME_HANDLERS = [importlib.import_module(frame_processor_name).create_frame_handler(modules.globals.source_path) for frame_processor_name in frame_processor_names]
+
+
+def process_stored_frame(frame_number: int, pass_name: str = None) -> int:
+    frame_store = get_frame_store(modules.globals.target_path)
+    temp_frame = handle_frame(PROCESS_FRAME_HANDLERS, frame_number, frame_store.read(frame_number))
+    if pass_name:
+        frame_store.write_pending(frame_number, temp_frame, pass_name)
+    else:
+        frame_store.write(frame_number, temp_frame)
+    return frame_number
+
+
+def multi_process_frame_store(frame_numbers: Iterable[int], frame_processor_names: List[str], on_frame_written: Callable[[int], None], progress: Any, pass_name: str = None) -> None:
+    # workers receive frame numbers only and read and write the shared frame store themselves
+    max_pending = modules.globals.execution_threads + modules.globals.frame_queue_size
+    with ProcessPoolExecutor(max_workers=modules.globals.execution_threads, mp_context=multiprocessing.get_context('spawn'), initializer=init_process_worker, initargs=(get_worker_globals(), frame_processor_names)) as executor:
+        pending: deque[Any] = deque()
+        for frame_number in frame_numbers:
+            pending.append(executor.submit(process_stored_frame, frame_number, pass_name))
+            if len(pending) >= max_pending:
+                on_frame_written(pending.popleft().result())
+                update_progress(progress)
+        while pending:
+            on_frame_written(pending.popleft().result())
+            update_progress(progress)
+
+
+def create_progress(total: int, position: int = 0) -> Any:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
-    total = len(frame_paths)
-    with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+    progress = tqdm(total=total or None, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format, position=position)
+    progress.set_postfix(get_progress_postfix())
+    progress.postfix_time = time.perf_counter()
+    return progress
+
+
+def get_progress_postfix() -> Dict[str, Any]:
+    return {'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory}
+
+
+def update_progress(progress: Any, n: int = 1) -> None:
+    progress.update(n)
+    # stage latencies change slowly, refreshing them on every frame would cost more than it shows
+    if time.perf_counter() - progress.postfix_time > PROGRESS_POSTFIX_INTERVAL:
+        progress.postfix_time = time.perf_counter()
+        progress.set_postfix({**get_progress_postfix(), **get_stage_postfix()}, refresh=False)
+
+
+def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None], frame_handler: Callable[[int, Frame], Frame] = None) -> None:
+    if frame_handler:
+        process_frame_paths(frame_paths, [frame_handler])
+        return
+    with create_progress(len(frame_paths)) as progress:
         multi_process_frame(source_path, frame_paths, process_frames, progress)
+
+
+def get_worker_globals() -> Dict[str, Any]:
+    return {name: getattr(modules.globals, name) for name in WORKER_GLOBALS}
+
+
+def init_worker(worker_globals: Dict[str, Any]) -> None:
+    for name, value in worker_globals.items():
+        setattr(modules.globals, name, value)
+
+
+def process_video_segment(segment_index: int, segment: Tuple[float, float], resolution: Tuple[int, int], fps: float) -> str:
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    segment_path = get_temp_segment_path(modules.globals.target_path, segment_index)
+    video_writer = create_video_writer(modules.globals.target_path, resolution, fps, output_path=segment_path)
+    try:
+        process_frame_stream(stream_frames(modules.globals.target_path, segment=segment), frame_processors, lambda frame_number, temp_frame: write_video_frame(video_writer, temp_frame), round(segment[1] * fps), segment_index)
+    finally:
+        if not close_video_writer(video_writer):
+            raise RuntimeError(f'Encoding segment {segment_index} failed')
+    return segment_path
+
+
+def process_video_segments(segments: List[Tuple[float, float]], resolution: Tuple[int, int], fps: float) -> List[str]:
+    # every segment gets its own interpreter, model sessions and encoder
+    with ProcessPoolExecutor(max_workers=len(segments), mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(get_worker_globals(),)) as executor:
+        futures = [executor.submit(process_video_segment, segment_index, segment, resolution, fps) for segment_index, segment in enumerate(segments)]
+        return [future.result() for future in futures]
@@ -1,13 +1,18 @@
-from typing import Any, List
+from typing import Any, List, Callable, Dict
 import cv2
 import threading
 import gfpgan
 import os
+import torch
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
 
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face
+from modules.face_analyser import get_one_face, get_many_faces
+from modules.face_tracker import FaceTracker, create_face_tracker
+from modules.metrics import measure
 from modules.typing import Frame, Face
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
 
@@ -45,7 +50,7 @@ def get_face_enhancer() -> Any:
 
 
 def enhance_face(temp_frame: Frame) -> Frame:
-    with THREAD_SEMAPHORE:
+    with THREAD_SEMAPHORE, measure('enhance'):
         _, _, temp_frame = get_face_enhancer().enhance(
             temp_frame,
             paste_back=True
@@ -53,8 +58,55 @@ def enhance_face(temp_frame: Frame) -> Frame:
     return temp_frame
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
+def enhance_faces_batch(temp_frames: List[Frame]) -> List[Frame]:
+    with THREAD_SEMAPHORE, measure('enhance'):
+        face_enhancer = get_face_enhancer()
+        face_helper = face_enhancer.face_helper
+        aligned_frames = []
+        for temp_frame in temp_frames:
+            face_helper.clean_all()
+            face_helper.read_image(temp_frame)
+            face_helper.get_face_landmarks_5(only_center_face=False, eye_dist_threshold=5)
+            face_helper.align_warp_face()
+            aligned_frames.append((face_helper.input_img, list(face_helper.cropped_faces), list(face_helper.affine_matrices)))
+        cropped_faces = [cropped_face for _, frame_cropped_faces, _ in aligned_frames for cropped_face in frame_cropped_faces]
+        if not cropped_faces:
+            return temp_frames
+        cropped_faces_t = []
+        for cropped_face in cropped_faces:
+            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+            cropped_faces_t.append(cropped_face_t)
+        # one forward pass for the aligned crops of every face in the batch
+        with torch.no_grad():
+            outputs = face_enhancer.gfpgan(torch.stack(cropped_faces_t).to(face_enhancer.device), return_rgb=False, weight=0.5)[0]
+        restored_faces = [tensor2img(output, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for output in outputs]
+        result_frames = []
+        for input_img, frame_cropped_faces, affine_matrices in aligned_frames:
+            face_helper.clean_all()
+            face_helper.input_img = input_img
+            face_helper.affine_matrices = affine_matrices
+            for _ in frame_cropped_faces:
+                face_helper.add_restored_face(restored_faces.pop(0))
+            face_helper.get_inverse_affine(None)
+            result_frames.append(face_helper.paste_faces_to_input_image() if frame_cropped_faces else input_img)
+        return result_frames
+
+
+def process_batch(temp_frames: List[Frame], context: Dict[str, Any]) -> List[Frame]:
+    temp_frames = list(temp_frames)
+    frame_indices = [frame_index for frame_index, temp_frame in enumerate(temp_frames) if get_one_face(temp_frame, 'detection')]
+    if frame_indices:
+        for frame_index, temp_frame in zip(frame_indices, enhance_faces_batch([temp_frames[frame_index] for frame_index in frame_indices])):
+            temp_frames[frame_index] = temp_frame
+    return temp_frames
+
+
+def process_frame(source_face: Face, temp_frame: Frame, face_tracker: FaceTracker = None, frame_number: int = None) -> Frame:
+    if face_tracker:
+        target_face = face_tracker.track(temp_frame, lambda frame: get_many_faces(frame, 'detection'), frame_number)
+    else:
+        target_face = get_one_face(temp_frame, 'detection')
     if target_face:
         temp_frame = enhance_face(temp_frame)
     return temp_frame
@@ -66,7 +118,12 @@ def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any
         result = process_frame(None, temp_frame)
         cv2.imwrite(temp_frame_path, result)
         if progress:
-            progress.update(1)
+            modules.processors.frame.core.update_progress(progress)
+
+
+def create_frame_handler(source_path: str) -> Callable[[int, Frame], Frame]:
+    face_tracker = create_face_tracker()
+    return lambda frame_number, temp_frame: process_frame(None, temp_frame, face_tracker, frame_number)
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
@@ -76,4 +133,4 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames, create_frame_handler(source_path))
@@ -1,19 +1,22 @@
-from typing import Any, List
+from typing import Any, List, Callable, Dict, Tuple
 import cv2
-import insightface
+import numpy as np
 import threading
+from insightface.utils import face_align
 
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face, get_many_faces, default_source_face
+from modules.face_analyser import get_one_face, get_many_faces, get_source_face, default_source_face
+from modules.face_tracker import FaceTracker, create_face_tracker
+from modules.metrics import measure
 from modules.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.session_pool import get_session, load_model
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video, get_temp_frame_number
 from modules.cluster_analysis import find_closest_centroid
 
-FACE_SWAPPER = None
-THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-SWAPPER'
+THREAD_LOCK = threading.Lock()
 
 
 def pre_check() -> bool:
@@ -26,7 +29,7 @@ def pre_start() -> bool:
     if not modules.globals.map_faces and not is_image(modules.globals.source_path):
         update_status('Select an image for source path.', NAME)
         return False
-    elif not modules.globals.map_faces and not get_one_face(cv2.imread(modules.globals.source_path)):
+    elif not modules.globals.map_faces and not get_source_face(modules.globals.source_path):
         update_status('No face in source path detected.', NAME)
         return False
     if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
@@ -35,38 +38,126 @@ def pre_start() -> bool:
     return True
 
 
+def create_face_swapper(session_options: Any) -> Any:
+    model_path = resolve_relative_path('../models/inswapper_128_fp16.onnx')
+    return load_model(model_path, session_options)
+
+
 def get_face_swapper() -> Any:
-    global FACE_SWAPPER
+    return get_session('face_swapper', create_face_swapper)
+
+
+def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    # insightface pastes back inside the same call, so this covers swap and paste back
+    with measure('swap'):
+        return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+
+
+def run_face_swapper(face_swapper: Any, blob: Any, latent: Any) -> Any:
+    try:
+        return face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob, face_swapper.input_names[1]: latent})[0]
+    except Exception:
+        # models exported with a fixed batch of one still get a single session call per face
+        return np.concatenate([face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob[index:index + 1], face_swapper.input_names[1]: latent[index:index + 1]})[0] for index in range(len(blob))])
+
+
+def paste_back(temp_frame: Frame, bgr_fake: Frame, aimg: Frame, M: Any) -> Frame:
+    # mirrors the paste back of insightface's INSwapper.get
+    IM = cv2.invertAffineTransform(M)
+    img_white = np.full((aimg.shape[0], aimg.shape[1]), 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, (temp_frame.shape[1], temp_frame.shape[0]), borderValue=0.0)
+    img_white = cv2.warpAffine(img_white, IM, (temp_frame.shape[1], temp_frame.shape[0]), borderValue=0.0)
+    img_white[img_white > 20] = 255
+    img_mask = img_white
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    if not len(mask_h_inds):
+        return temp_frame
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h * mask_w))
+    k = max(mask_size // 10, 10)
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+    img_mask /= 255
+    img_mask = np.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+    fake_merged = img_mask * bgr_fake + (1 - img_mask) * temp_frame.astype(np.float32)
+    return fake_merged.astype(np.uint8)
+
+
+def swap_faces_batch(source_face: Face, target_faces: List[Tuple[int, Face]], temp_frames: List[Frame]) -> List[Frame]:
+    face_swapper = get_face_swapper()
+    crops = [face_align.norm_crop2(temp_frames[frame_index], target_face.kps, face_swapper.input_size[0]) for frame_index, target_face in target_faces]
+    blob = cv2.dnn.blobFromImages([aimg for aimg, _ in crops], 1.0 / face_swapper.input_std, face_swapper.input_size, (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+    latent = np.dot(source_face.normed_embedding.reshape((1, -1)), face_swapper.emap)
+    latent /= np.linalg.norm(latent)
+    # one session call for the aligned 128x128 crops of every face in the batch
+    with measure('swap'):
+        preds = run_face_swapper(face_swapper, blob, np.repeat(latent, len(crops), axis=0))
+    for (frame_index, _), (aimg, M), pred in zip(target_faces, crops, preds):
+        bgr_fake = np.clip(255 * pred.transpose((1, 2, 0)), 0, 255).astype(np.uint8)[:, :, ::-1]
+        with measure('paste_back'):
+            temp_frames[frame_index] = paste_back(temp_frames[frame_index], bgr_fake, aimg, M)
+    return temp_frames
 
+
+def get_batch_source_face(context: Dict[str, Any]) -> Face:
     with THREAD_LOCK:
-        if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128_fp16.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
-    return FACE_SWAPPER
+        if 'source_face' not in context:
+            context['source_face'] = get_source_face(context['source_path'])
+    return context['source_face']
 
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+def process_batch(temp_frames: List[Frame], context: Dict[str, Any]) -> List[Frame]:
+    source_face = get_batch_source_face(context)
+    target_faces = []
+    temp_frames = list(temp_frames)
+    for frame_index, temp_frame in enumerate(temp_frames):
+        if modules.globals.color_correction:
+            temp_frames[frame_index] = temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
+        if modules.globals.many_faces:
+            target_faces.extend((frame_index, target_face) for target_face in get_many_faces(temp_frame, 'detection') or [])
+        else:
+            target_face = get_one_face(temp_frame, 'detection')
+            if target_face:
+                target_faces.append((frame_index, target_face))
+    if not source_face or not target_faces:
+        return temp_frames
+    return swap_faces_batch(source_face, target_faces, temp_frames)
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+def process_frame(source_face: Face, temp_frame: Frame, face_tracker: FaceTracker = None, frame_number: int = None) -> Frame:
     # Ensure the frame is in RGB format if color correction is enabled
     if modules.globals.color_correction:
         temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
         
-    if modules.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
+    if face_tracker:
+        target_faces = face_tracker.track(temp_frame, lambda frame: get_many_faces(frame, 'detection'), frame_number)
+        if not modules.globals.many_faces:
+            target_faces = sorted(target_faces, key=lambda x: x.bbox[0])[:1]
+        for target_face in target_faces:
+            temp_frame = swap_face(source_face, target_face, temp_frame)
+    elif modules.globals.many_faces:
+        many_faces = get_many_faces(temp_frame, 'detection')
         if many_faces:
             for target_face in many_faces:
                 temp_frame = swap_face(source_face, target_face, temp_frame)
     else:
-        target_face = get_one_face(temp_frame)
+        target_face = get_one_face(temp_frame, 'detection')
         if target_face:
             temp_frame = swap_face(source_face, target_face, temp_frame)
     return temp_frame
 
 
-def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
+def get_mapped_target_faces(temp_frame: Frame, frame_number: int) -> List[Face]:
+    face_track_store = modules.globals.face_track_store
+    if face_track_store.is_analysed(frame_number):
+        return face_track_store.get_faces(frame_number)
+    # frames outside the sampled analysis are assigned to the nearest identity here, before any face is swapped
+    return face_track_store.assign_faces(get_many_faces(temp_frame, 'recognition') or [])
+
+
+def process_frame_v2(temp_frame: Frame, frame_number: int = -1) -> Frame:
     if is_image(modules.globals.target_path):
         if modules.globals.many_faces:
             source_face = default_source_face()
@@ -82,26 +173,23 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                     temp_frame = swap_face(source_face, target_face, temp_frame)
 
     elif is_video(modules.globals.target_path):
+        target_faces = get_mapped_target_faces(temp_frame, frame_number)
         if modules.globals.many_faces:
             source_face = default_source_face()
             for map in modules.globals.souce_target_map:
-                target_frame = [f for f in map['target_faces_in_frame'] if f['location'] == temp_frame_path]
-
-                for frame in target_frame:
-                    for target_face in frame['faces']:
-                        temp_frame = swap_face(source_face, target_face, temp_frame)
+                for target_face in [target_face for target_face in target_faces if target_face.target_centroid == map['id']]:
+                    temp_frame = swap_face(source_face, target_face, temp_frame)
 
         elif not modules.globals.many_faces:
             for map in modules.globals.souce_target_map:
                 if "source" in map:
-                    target_frame = [f for f in map['target_faces_in_frame'] if f['location'] == temp_frame_path]
                     source_face = map['source']['face']
 
-                    for frame in target_frame:
-                        for target_face in frame['faces']:
-                            temp_frame = swap_face(source_face, target_face, temp_frame)
+                    for target_face in [target_face for target_face in target_faces if target_face.target_centroid == map['id']]:
+                        temp_frame = swap_face(source_face, target_face, temp_frame)
     else:
-        detected_faces = get_many_faces(temp_frame)
+        # live mapping matches the detected faces by embedding
+        detected_faces = get_many_faces(temp_frame, 'recognition')
         if modules.globals.many_faces:
             if detected_faces:
                 source_face = default_source_face()
@@ -130,7 +218,7 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
 
 def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
     if not modules.globals.map_faces:
-        source_face = get_one_face(cv2.imread(source_path))
+        source_face = get_source_face(source_path)
         for temp_frame_path in temp_frame_paths:
             temp_frame = cv2.imread(temp_frame_path)
             try:
@@ -140,23 +228,31 @@ def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any
                 print(exception)
                 pass
             if progress:
-                progress.update(1)
+                modules.processors.frame.core.update_progress(progress)
     else:
         for temp_frame_path in temp_frame_paths:
             temp_frame = cv2.imread(temp_frame_path)
             try:
-                result = process_frame_v2(temp_frame, temp_frame_path)
+                result = process_frame_v2(temp_frame, get_temp_frame_number(temp_frame_path))
                 cv2.imwrite(temp_frame_path, result)
             except Exception as exception:
                 print(exception)
                 pass
             if progress:
-                progress.update(1)
+                modules.processors.frame.core.update_progress(progress)
+
+
+def create_frame_handler(source_path: str) -> Callable[[int, Frame], Frame]:
+    if modules.globals.map_faces:
+        return lambda frame_number, temp_frame: process_frame_v2(temp_frame, frame_number)
+    source_face = get_source_face(source_path)
+    face_tracker = create_face_tracker()
+    return lambda frame_number, temp_frame: process_frame(source_face, temp_frame, face_tracker, frame_number)
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
     if not modules.globals.map_faces:
-        source_face = get_one_face(cv2.imread(source_path))
+        source_face = get_source_face(source_path)
         target_frame = cv2.imread(target_path)
         result = process_frame(source_face, target_frame)
         cv2.imwrite(output_path, result)
@@ -171,4 +267,4 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
     if modules.globals.map_faces and modules.globals.many_faces:
         update_status('Many faces enabled. Using first source image. Progressing...', NAME)
-    modules.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames)
+    modules.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames, create_frame_handler(source_path))
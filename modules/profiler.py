@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Iterator
+
+import modules.globals
+
+STACK_COUNTS: Counter[str] = Counter()
+PROFILER_LOCK = threading.Lock()
+PROFILER_STATE = {'depth': 0, 'thread': None, 'stop_event': None}
+
+
+def get_frame_name(frame: Any) -> str:
+    # the first line keeps one entry per function, collapsed stacks are separated by semicolons
+    return f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})'.replace(';', ':')
+
+
+def sample_stacks(stop_event: threading.Event, interval: float) -> None:
+    sampler_id = threading.get_ident()
+    while not stop_event.wait(interval):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            STACK_COUNTS[';'.join([thread_names.get(thread_id, str(thread_id)).replace(';', ':')] + stack[::-1])] += 1
+
+
+def start_profiler() -> None:
+    stop_event = threading.Event()
+    PROFILER_STATE['stop_event'] = stop_event
+    PROFILER_STATE['thread'] = threading.Thread(target=sample_stacks, args=(stop_event, modules.globals.profile_interval / 1000), name='profiler', daemon=True)
+    PROFILER_STATE['thread'].start()
+
+
+def stop_profiler() -> None:
+    PROFILER_STATE['stop_event'].set()
+    PROFILER_STATE['thread'].join()
+    PROFILER_STATE['thread'] = None
+    write_profile(modules.globals.profile_path)
+
+
+def write_profile(profile_path: str) -> None:
+    # samples add up over every profiled job of the session
+    stack_counts = STACK_COUNTS.copy()
+    with open(profile_path, 'w') as profile_file:
+        for stack, count in stack_counts.most_common():
+            profile_file.write(f'{stack} {count}\n')
+    print(f'[DLC.PROFILER] {sum(stack_counts.values())} samples written to {profile_path}')
+
+
+def flush_profile() -> None:
+    # an interrupted job still leaves the samples taken so far
+    if modules.globals.profile_path and STACK_COUNTS:
+        write_profile(modules.globals.profile_path)
+
+
+@contextmanager
+def profile() -> Iterator[None]:
+    # without --profile no sampler thread exists, so there is nothing to pay for
+    if not modules.globals.profile_path:
+        yield
+        return
+    with PROFILER_LOCK:
+        PROFILER_STATE['depth'] += 1
+        if PROFILER_STATE['depth'] == 1:
+            start_profiler()
+    try:
+        yield
+    finally:
+        with PROFILER_LOCK:
+            PROFILER_STATE['depth'] -= 1
+            if PROFILER_STATE['depth'] == 0:
+                stop_profiler()
+
+
+def profiled(function: Callable[..., Any]) -> Callable[..., Any]:
+    @wraps(function)
+    def profiled_function(*args: Any, **kwargs: Any) -> Any:
+        with profile():
+            return function(*args, **kwargs)
+
+    return profiled_function
@@ -0,0 +1,71 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List
+import onnxruntime
+from insightface.model_zoo.model_zoo import ModelRouter
+
+import modules.globals
+
+SESSIONS: Dict[str, Any] = {}
+SESSIONS_LOCK = threading.Lock()
+SESSION_SLOTS: List[int] = []
+FREE_SESSION_SLOTS: List[int] = []
+THREAD_SESSIONS = threading.local()
+
+
+def get_intra_op_threads() -> int:
+    if modules.globals.intra_op_threads:
+        return modules.globals.intra_op_threads
+    # split the cores between the concurrent callers and the threads inside each call
+    callers = max(1, modules.globals.execution_threads or 1) * max(1, modules.globals.video_segments)
+    return max(1, (os.cpu_count() or 1) // callers)
+
+
+def create_session_options() -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = get_intra_op_threads()
+    session_options.inter_op_num_threads = 1
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    return session_options
+
+
+def load_model(model_file: str, session_options: onnxruntime.SessionOptions) -> Any:
+    # insightface's get_model drops sess_options, its router passes them on to the session
+    return ModelRouter(model_file).get_model(sess_options=session_options, providers=modules.globals.execution_providers)
+
+
+@contextmanager
+def session_slot() -> Iterator[None]:
+    # with --session-per-thread a caller checks out its own set of sessions, the sets outlive the threads and jobs using them
+    if not modules.globals.session_per_thread:
+        yield
+        return
+    with SESSIONS_LOCK:
+        if not FREE_SESSION_SLOTS:
+            FREE_SESSION_SLOTS.append(len(SESSION_SLOTS))
+            SESSION_SLOTS.append(len(SESSION_SLOTS))
+        FREE_SESSION_SLOTS.sort()
+        slot = FREE_SESSION_SLOTS.pop(0)
+    THREAD_SESSIONS.slot = slot
+    try:
+        yield
+    finally:
+        del THREAD_SESSIONS.slot
+        with SESSIONS_LOCK:
+            FREE_SESSION_SLOTS.append(slot)
+
+
+def get_session(name: str, create_session: Callable[[onnxruntime.SessionOptions], Any]) -> Any:
+    slot = getattr(THREAD_SESSIONS, 'slot', None)
+    if slot is not None:
+        name = f'{name}#{slot}'
+    with SESSIONS_LOCK:
+        if name not in SESSIONS:
+            SESSIONS[name] = create_session(create_session_options())
+    return SESSIONS[name]
+
+
+def clear_sessions() -> None:
+    with SESSIONS_LOCK:
+        SESSIONS.clear()
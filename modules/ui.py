@@ -10,14 +10,17 @@ import modules.globals
 import modules.metadata
 from modules.face_analyser import (
     get_one_face,
+    get_source_face,
     get_unique_faces_from_target_image,
     get_unique_faces_from_target_video,
     add_blank_map,
     has_valid_map,
     simplify_maps,
 )
-from modules.capturer import get_video_frame, get_video_frame_total
+from modules.capturer import get_video_frame, get_video_frame_total, get_video_reader
 from modules.processors.frame.core import get_frame_processors_modules
+from modules.profiler import profile
+from modules.face_tracker import FaceTracker
 from modules.utilities import (
     is_image,
     is_video,
@@ -523,7 +526,7 @@ def update_popup_source(
     else:
         RECENT_DIRECTORY_SOURCE = os.path.dirname(source_path)
         cv2_img = cv2.imread(source_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, "recognition")
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -747,17 +750,12 @@ def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage
 def render_video_preview(
     video_path: str, size: Tuple[int, int], frame_number: int = 0
 ) -> ctk.CTkImage:
-    capture = cv2.VideoCapture(video_path)
-    if frame_number:
-        capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-    has_frame, frame = capture.read()
-    if has_frame:
+    frame = get_video_reader(video_path).read(frame_number)
+    if frame is not None:
         image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
         if size:
             image = ImageOps.fit(image, size, Image.LANCZOS)
         return ctk.CTkImage(image, size=image.size)
-    capture.release()
-    cv2.destroyAllWindows()
 
 
 def toggle_preview() -> None:
@@ -788,7 +786,7 @@ def update_preview(frame_number: int = 0) -> None:
             modules.globals.frame_processors
         ):
             temp_frame = frame_processor.process_frame(
-                get_one_face(cv2.imread(modules.globals.source_path)), temp_frame
+                get_source_face(modules.globals.source_path), temp_frame
             )
         image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
         image = ImageOps.contain(
@@ -835,6 +833,24 @@ def create_webcam_preview():
 
     source_image = None  # Initialize variable for the selected face image
 
+    modules.globals.webcam_preview_running = True
+    try:
+        with profile():
+            run_webcam_loop(camera, frame_processors, source_image)
+    finally:
+        modules.globals.webcam_preview_running = False
+
+    camera.release()
+    PREVIEW.withdraw()  # Close preview window when loop is finished
+
+
+def run_webcam_loop(camera, frame_processors, source_image):
+    # webcam frames always arrive in order, so every processor can track its faces
+    face_trackers = [
+        FaceTracker() if modules.globals.face_tracker_interval > 1 else None
+        for _ in frame_processors
+    ]
+
     while camera:
         ret, frame = camera.read()
         if not ret:
@@ -853,10 +869,12 @@ def create_webcam_preview():
         if not modules.globals.map_faces:
             # Select and save face image only once
             if source_image is None and modules.globals.source_path:
-                source_image = get_one_face(cv2.imread(modules.globals.source_path))
+                source_image = get_source_face(modules.globals.source_path)
 
-            for frame_processor in frame_processors:
-                temp_frame = frame_processor.process_frame(source_image, temp_frame)
+            for frame_processor, face_tracker in zip(frame_processors, face_trackers):
+                temp_frame = frame_processor.process_frame(
+                    source_image, temp_frame, face_tracker
+                )
         else:
             modules.globals.target_path = None
 
@@ -877,9 +895,6 @@ def create_webcam_preview():
         if PREVIEW.state() == "withdrawn":
             break
 
-    camera.release()
-    PREVIEW.withdraw()  # Close preview window when loop is finished
-
 
 def create_source_target_popup_for_webcam(root: ctk.CTk, map: list) -> None:
     global POPUP_LIVE, popup_status_label_live
@@ -1040,7 +1055,7 @@ def update_webcam_source(
         return map
     else:
         cv2_img = cv2.imread(source_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, "recognition")
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -1093,7 +1108,7 @@ def update_webcam_target(
         return map
     else:
         cv2_img = cv2.imread(target_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, "recognition")
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -1,19 +1,34 @@
+import csv
 import glob
+import hashlib
+import json
 import mimetypes
 import os
 import platform
+import queue
 import shutil
 import ssl
 import subprocess
+import threading
 import urllib
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Iterator, Tuple
+import numpy
 from tqdm import tqdm
 
 import modules.globals
+from modules.metrics import measure
+from modules.typing import Frame
 
 TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
+TEMP_SEGMENT_FILE = 'segment-{:04d}.mp4'
+TEMP_SEGMENT_LIST = 'segments.txt'
+BATCH_MANIFEST_EXTENSIONS = ('.txt', '.csv', '.json')
+PREFETCH_CHUNK_SIZE = 16 * 1024 ** 2
+CONTENT_HASH_CHUNK_SIZE = 4 * 1024 ** 2
+# codecs every ffmpeg build accepts in mp4, the streaming encode has no remux fallback
+MUXABLE_AUDIO_CODECS = ['aac', 'mp3', 'ac3', 'eac3']
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
@@ -42,27 +57,224 @@ def detect_fps(target_path: str) -> float:
     return 30.0
 
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation', '-of', 'json', target_path]
+    stream = json.loads(subprocess.check_output(command).decode())['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    # ffmpeg autorotates on decode, so report the displayed resolution
+    rotation = int(stream.get('tags', {}).get('rotate', 0))
+    for side_data in stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+    if abs(rotation) % 180 == 90:
+        return height, width
+    return width, height
+
+
+def detect_duration(target_path: str) -> float:
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
+    try:
+        return float(subprocess.check_output(command).decode().strip())
+    except Exception:
+        pass
+    return 0.0
+
+
+def detect_keyframes(target_path: str) -> List[float]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey', '-show_entries', 'frame=best_effort_timestamp_time', '-of', 'csv=p=0', target_path]
+    keyframes = []
+    for line in subprocess.check_output(command).decode().splitlines():
+        try:
+            keyframes.append(float(line.strip().rstrip(',')))
+        except ValueError:
+            pass
+    return sorted(keyframes)
+
+
+def detect_keyframe_numbers(target_path: str) -> List[int]:
+    # packet order is close enough to display order for seeking and sampling
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=flags', '-of', 'csv=p=0', target_path]
+    try:
+        flags = subprocess.check_output(command).decode().split()
+        return [frame_number for frame_number, flag in enumerate(flags) if 'K' in flag] or [0]
+    except Exception:
+        return [0]
+
+
+def get_video_segments(target_path: str, segment_total: int) -> List[Tuple[float, float]]:
+    duration = detect_duration(target_path)
+    keyframes = detect_keyframes(target_path)
+    if segment_total < 2 or not duration or len(keyframes) < 2:
+        return [(0.0, duration)]
+    # cut at the keyframe closest to each even split, so every segment decodes on its own
+    cuts = []
+    for index in range(1, segment_total):
+        cut = min(keyframes, key=lambda keyframe: abs(keyframe - duration * index / segment_total))
+        if 0 < cut < duration and cut not in cuts:
+            cuts.append(cut)
+    bounds = [0.0] + sorted(cuts) + [duration]
+    return [(start, end - start) for start, end in zip(bounds, bounds[1:])]
+
+
+def detect_audio_codec(target_path: str) -> Any:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
+    try:
+        return subprocess.check_output(command).decode().strip() or None
+    except Exception:
+        pass
+    return None
+
+
+def can_mux_audio(target_path: str) -> bool:
+    return detect_audio_codec(target_path) in MUXABLE_AUDIO_CODECS
+
+
+def detect_frame_total(target_path: str) -> int:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
+    try:
+        return int(subprocess.check_output(command).decode().strip())
+    except Exception:
+        pass
+    return 0
+
+
 def extract_frames(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
+    with measure('extract'):
+        run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
 
 
-def create_video(target_path: str, fps: float = 30.0) -> None:
+def read_pipe(pipe: Any, buffer: bytearray) -> bool:
+    view = memoryview(buffer)
+    position = 0
+    while position < len(buffer):
+        size = pipe.readinto(view[position:])
+        if not size:
+            return False
+        position += size
+    return True
+
+
+def stream_frames(target_path: str, queue_size: int = None, segment: Tuple[float, float] = None) -> Iterator[Tuple[int, Frame]]:
+    width, height = detect_resolution(target_path)
+    commands = ['ffmpeg', '-hide_banner', '-hwaccel', 'auto', '-loglevel', modules.globals.log_level]
+    if segment:
+        start, duration = segment
+        commands.extend(['-ss', str(start), '-t', str(duration)])
+    commands.extend(['-i', target_path, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'])
+    process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frame_queue: queue.Queue[Any] = queue.Queue(maxsize=queue_size or modules.globals.frame_queue_size)
+    stop_event = threading.Event()
+
+    def decode_frames() -> None:
+        frame_number = 0
+        while not stop_event.is_set():
+            buffer = bytearray(width * height * 3)
+            with measure('decode'):
+                has_frame = read_pipe(process.stdout, buffer)
+            if not has_frame:
+                break
+            frame_queue.put((frame_number, numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, width, 3)))
+            frame_number += 1
+        frame_queue.put(None)
+
+    decoder = threading.Thread(target=decode_frames, daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        stop_event.set()
+        process.kill()
+        # drain so the decoder is never left blocked on a full queue
+        while decoder.is_alive():
+            try:
+                frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        process.wait()
+
+
+def get_encode_args(target_path: str, mux_audio: bool, output_path: str = None) -> List[str]:
+    args = []
+    # the frames come in as input 0 at the detected fps, the source audio is copied from input 1
+    if mux_audio:
+        args.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'copy'])
+    args.extend(['-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', output_path or get_temp_output_path(target_path)])
+    return args
+
+
+def create_video(target_path: str, fps: float = 30.0, mux_audio: bool = False) -> bool:
+    temp_directory_path = get_temp_directory_path(target_path)
+    with measure('encode'):
+        return run_ffmpeg(['-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.png')] + get_encode_args(target_path, mux_audio))
+
+
+def create_video_writer(target_path: str, resolution: Tuple[int, int], fps: float = 30.0, mux_audio: bool = False, output_path: str = None) -> subprocess.Popen[bytes]:
+    width, height = resolution
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+    commands.extend(get_encode_args(target_path, mux_audio, output_path))
+    return subprocess.Popen(commands, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+def write_video_frame(video_writer: subprocess.Popen[bytes], frame: Frame) -> None:
+    # the pipe blocks while the encoder is busy, so this is the encode time per frame
+    with measure('encode'):
+        video_writer.stdin.write(numpy.ascontiguousarray(frame).data)
+
+
+def close_video_writer(video_writer: subprocess.Popen[bytes]) -> bool:
+    try:
+        video_writer.stdin.close()
+    except BrokenPipeError:
+        pass
+    return video_writer.wait() == 0
+
+
+def concat_videos(target_path: str, segment_paths: List[str], mux_audio: bool = False) -> bool:
     temp_output_path = get_temp_output_path(target_path)
+    segment_list_path = os.path.join(get_temp_directory_path(target_path), TEMP_SEGMENT_LIST)
+    with open(segment_list_path, 'w') as segment_list:
+        for segment_path in segment_paths:
+            segment_list.write("file '{}'\n".format(os.path.abspath(segment_path).replace("'", "'\\''")))
+    args = ['-f', 'concat', '-safe', '0', '-i', segment_list_path]
+    if mux_audio:
+        args.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0'])
+    args.extend(['-c', 'copy', '-y', temp_output_path])
+    return run_ffmpeg(args)
+
+
+def get_temp_segment_path(target_path: str, segment_index: int) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.png'), '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
+    return os.path.join(temp_directory_path, TEMP_SEGMENT_FILE.format(segment_index))
 
 
 def restore_audio(target_path: str, output_path: str) -> None:
     temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
+    with measure('restore_audio'):
+        done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
     if not done:
         move_temp(target_path, output_path)
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    return sorted(glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png'))), key=get_temp_frame_number)
+
+
+def get_temp_frame_path(target_path: str, frame_number: int) -> str:
+    temp_directory_path = get_temp_directory_path(target_path)
+    return os.path.join(temp_directory_path, f'{frame_number + 1:04d}.png')
+
+
+def get_temp_frame_number(temp_frame_path: str) -> int:
+    frame_name, _ = os.path.splitext(os.path.basename(temp_frame_path))
+    try:
+        return int(frame_name) - 1
+    except ValueError:
+        return -1
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -85,6 +297,62 @@ def normalize_output_path(source_path: str, target_path: str, output_path: str)
     return output_path
 
 
+def is_batch_target(target_path: str) -> bool:
+    if not target_path:
+        return False
+    # an existing file is a single target even if its name looks like a glob
+    if os.path.isfile(target_path) and (is_image(target_path) or is_video(target_path)):
+        return False
+    return os.path.isdir(target_path) or glob.has_magic(target_path) or target_path.lower().endswith(BATCH_MANIFEST_EXTENSIONS)
+
+
+def get_batch_jobs(source_path: str, target_path: str, output_path: str) -> List[Tuple[str, str, str]]:
+    jobs = []
+    if target_path.lower().endswith(BATCH_MANIFEST_EXTENSIONS) and os.path.isfile(target_path):
+        manifest_directory_path = os.path.dirname(os.path.abspath(target_path))
+        if target_path.lower().endswith('.json'):
+            with open(target_path) as manifest_file:
+                rows = [[row.get('source'), row['target'], row.get('output')] for row in json.load(manifest_file)]
+        else:
+            with open(target_path) as manifest_file:
+                rows = [next(csv.reader([line])) for line in manifest_file if line.strip() and not line.startswith('#')]
+            # a row is either target, source and target or source, target and output
+            rows = [[None] + row if len(row) == 1 else row for row in rows]
+        for row in rows:
+            # only paths read from the manifest are relative to it, the command line paths stay as given
+            job_source_path, job_target_path, job_output_path = [os.path.join(manifest_directory_path, path.strip()) if path and path.strip() else None for path in (row + [None, None])[:3]]
+            jobs.append((job_source_path or source_path, job_target_path, job_output_path or output_path))
+    else:
+        if os.path.isdir(target_path):
+            target_paths = [os.path.join(target_path, name) for name in sorted(os.listdir(target_path))]
+        else:
+            target_paths = sorted(glob.glob(target_path))
+        jobs = [(source_path, path, output_path) for path in target_paths if is_image(path) or is_video(path)]
+    return [(job_source_path, job_target_path, normalize_output_path(job_source_path, job_target_path, job_output_path)) for job_source_path, job_target_path, job_output_path in jobs]
+
+
+def prefetch_file(file_path: str) -> None:
+    # pull the file into the page cache while the previous job is still busy
+    if file_path and os.path.isfile(file_path):
+        with open(file_path, 'rb') as file:
+            while file.read(PREFETCH_CHUNK_SIZE):
+                pass
+
+
+def get_content_hash(file_path: str) -> str:
+    file_size = os.path.getsize(file_path)
+    content_hash = hashlib.sha256(str(file_size).encode())
+    with open(file_path, 'rb') as file:
+        if file_size <= CONTENT_HASH_CHUNK_SIZE * 3:
+            content_hash.update(file.read())
+        else:
+            # head, middle and tail stand in for a large video, hashing all of it would cost more than the lookup saves
+            for offset in [0, (file_size - CONTENT_HASH_CHUNK_SIZE) // 2, file_size - CONTENT_HASH_CHUNK_SIZE]:
+                file.seek(offset)
+                content_hash.update(file.read(CONTENT_HASH_CHUNK_SIZE))
+    return content_hash.hexdigest()
+
+
 def create_temp(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
     Path(temp_directory_path).mkdir(parents=True, exist_ok=True)